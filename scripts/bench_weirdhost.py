@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# scripts/bench_weirdhost.py
+#
+# 基于本地面板替身的端到端基准测试，完全离线（需预先安装 chromedriver: sbase get uc_driver）：
+#   python scripts/bench_weirdhost.py --accounts 1 10 50
+#
+# 每个场景在独立子进程中运行 weirdhost_renew.py，从 trace 文件统计每个账号的耗时与 WebDriver 命令数。
+# --shards N 时同时启动 N 个 --shard i/N 进程，结束后用 --merge-report 合并，模拟矩阵工作流。
+# --headless 时以无头模式运行并用 CDP 点击，不启动 Xvfb。
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import web
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from fake_weirdhost import FakePanel, OUTCOMES  # noqa: E402
+from weirdhost_renew import percentile, start_virtual_display  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_panel(panel, port):
+    ready = threading.Event()
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(panel.app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    ready.wait()
+
+
+def build_env(origin, n_accounts, outcome, workdir, extra_env):
+    accounts = []
+    env = dict(os.environ)
+    for i in range(n_accounts):
+        cookie_env = f"BENCH_COOKIE_{i + 1}"
+        server_id = f"{outcome}-n{n_accounts}-{i + 1:04d}"
+        accounts.append({"remark": f"bench-{i + 1}", "id": server_id, "cookie_env": cookie_env})
+        env[cookie_env] = f"remember_web_bench={'x' * 40}{i}"
+    env.update({
+        "ACCOUNTS": json.dumps(accounts),
+        "WEIRDHOST_ORIGIN": origin,
+        "TG_API_BASE": origin,
+        "TG_BOT_TOKEN": "bench",
+        "TG_CHAT_ID": "1",
+        "STATE_DIR": os.path.join(workdir, "state"),
+        "TRACE_FILE": os.path.join(workdir, "trace.json"),
+        "REPO_TOKEN": "",
+    })
+    env.update(extra_env)
+    return env
+
+
+def summarize_trace(trace_files):
+    events = []
+    for trace_file in trace_files:
+        with open(trace_file, "r", encoding="utf-8") as f:
+            events.extend(json.load(f)["traceEvents"])
+    accounts = [e for e in events if e["name"] == "account"]
+    latencies = [e["dur"] / 1e6 for e in accounts]
+    commands = [e["args"].get("webdriver_commands", 0) for e in accounts]
+    scripts = [e["args"].get("execute_script", 0) for e in accounts]
+    kbytes = [e["args"].get("resource_bytes", 0) / 1024 for e in accounts]
+    saved = [e["args"].get("resource_saved", 0) / 1024 for e in accounts]
+    return latencies, commands, scripts, kbytes, saved
+
+
+def run_scenario(origin, n_accounts, outcome, workers, extra_env, shards=1):
+    script = os.path.join(SCRIPTS_DIR, "weirdhost_renew.py")
+    with tempfile.TemporaryDirectory(prefix="weirdhost_bench_") as workdir:
+        env = build_env(origin, n_accounts, outcome, workdir, extra_env)
+        start = time.time()
+        if shards > 1:
+            # 每个分片使用独立的状态目录和 trace 文件，与矩阵工作流中各 runner 互相隔离一致
+            procs = []
+            for k in range(1, shards + 1):
+                shard_env = dict(env, STATE_DIR=os.path.join(workdir, f"state_{k}"),
+                                 TRACE_FILE=os.path.join(workdir, f"trace_{k}.json"))
+                procs.append(subprocess.Popen(
+                    [sys.executable, script, "--force-refresh", "--workers", str(workers),
+                     "--shard", f"{k}/{shards}", "--shard-output", os.path.join(workdir, f"shard_{k}.json")],
+                    env=shard_env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
+                ))
+            returncode = max(p.wait() for p in procs)
+            if returncode == 0:
+                returncode = subprocess.run(
+                    [sys.executable, script, "--merge-report",
+                     *(os.path.join(workdir, f"shard_{k}.json") for k in range(1, shards + 1))],
+                    env=env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
+                ).returncode
+            trace_files = [os.path.join(workdir, f"trace_{k}.json") for k in range(1, shards + 1)]
+        else:
+            returncode = subprocess.run(
+                [sys.executable, script, "--force-refresh", "--workers", str(workers)],
+                env=env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT
+            ).returncode
+            trace_files = [env["TRACE_FILE"]]
+        wall = time.time() - start
+        trace_files = [f for f in trace_files if os.path.exists(f)]
+        if returncode != 0 or not trace_files:
+            return {"accounts": n_accounts, "wall": wall, "error": f"exit {returncode}"}
+        latencies, commands, scripts, kbytes, saved = summarize_trace(trace_files)
+    if not latencies:
+        return {"accounts": n_accounts, "wall": wall, "error": "没有账号进入浏览器流程"}
+    return {
+        "accounts": n_accounts,
+        "wall": wall,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "commands": sum(commands) / len(commands) if commands else 0,
+        "scripts": sum(scripts) / len(scripts) if scripts else 0,
+        "kbytes": sum(kbytes) / len(kbytes) if kbytes else 0,
+        "saved": sum(saved) / len(saved) if saved else 0,
+    }
+
+
+def print_table(rows):
+    print(f"\n{'账号数':>6} {'总耗时':>8} {'p50':>7} {'p90':>7} {'p99':>7} {'命令/账号':>9} {'脚本/账号':>9} {'KB/账号':>8} {'节省KB':>7}")
+    for r in rows:
+        if r.get("error"):
+            print(f"{r['accounts']:>6} {r['wall']:>7.1f}s  失败: {r['error']}")
+            continue
+        print(f"{r['accounts']:>6} {r['wall']:>7.1f}s {r['p50']:>6.1f}s {r['p90']:>6.1f}s {r['p99']:>6.1f}s "
+              f"{r['commands']:>9.0f} {r['scripts']:>9.0f} {r['kbytes']:>8.0f} {r['saved']:>7.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="weirdhost 续期流程离线基准测试")
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--outcome", choices=OUTCOMES, default="success")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--shards", type=int, default=1, help="拆成 N 个分片进程并发运行，最后合并报告")
+    parser.add_argument("--expiry-days", type=float, default=1.0,
+                        help="初始剩余天数，大于 RENEW_THRESHOLD_DAYS 时测的是跳过路径")
+    parser.add_argument("--no-http-probe", action="store_true")
+    parser.add_argument("--resource-policy", choices=("lean", "observe", "off"),
+                        help="覆盖 RESOURCE_POLICY；observe 统计 lean 会拦截的请求和流量而不拦截")
+    parser.add_argument("--headless", action="store_true", help="无头模式 (HEADLESS=1)，不需要 Xvfb")
+    parser.add_argument("--json", help="把结果另存为 JSON")
+    args = parser.parse_args(argv)
+
+    xvfb = None
+    if not args.headless and not os.environ.get("DISPLAY"):
+        xvfb = start_virtual_display()
+
+    try:
+        port = free_port()
+        panel = FakePanel(default_outcome=args.outcome, expiry_days=args.expiry_days)
+        start_panel(panel, port)
+        origin = f"http://127.0.0.1:{port}"
+        extra_env = {"HTTP_PROBE": "0"} if args.no_http_probe else {}
+        if args.resource_policy:
+            extra_env["RESOURCE_POLICY"] = args.resource_policy
+        if args.headless:
+            extra_env["HEADLESS"] = "1"
+
+        rows = []
+        for n in args.accounts:
+            print(f"[Bench] {n} 个账号 ({args.outcome}) ...")
+            rows.append(run_scenario(origin, n, args.outcome, args.workers, extra_env, args.shards))
+        print_table(rows)
+        print(f"\n[Bench] 面板请求: {panel.stats}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(rows, f, indent=1)
+    finally:
+        if xvfb:
+            xvfb.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# scripts/fake_weirdhost.py
+#
+# 本地 weirdhost 面板替身，用于离线测试与基准测试：
+#   python scripts/fake_weirdhost.py --port 8765
+#   WEIRDHOST_ORIGIN=http://127.0.0.1:8765 TG_API_BASE=http://127.0.0.1:8765 python scripts/weirdhost_renew.py
+#
+# 服务器 ID 以结果名开头即可指定该服务器的续期结果，例如 cooldown-3、timeout-1、logged_out-2；
+# 其余 ID 使用 --outcome 指定的默认结果。
+
+import argparse
+import asyncio
+import os
+import random
+import string
+import struct
+import zlib
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+OUTCOMES = ("success", "cooldown", "timeout", "logged_out")
+RENEW_HOURS = 72
+
+
+def make_png(width, height):
+    """随机像素的 PNG，几乎不可压缩，用来模拟面板上的大图"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    rows = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows))
+            + chunk(b"IEND", b""))
+
+
+# 侧栏背景图，约 190KB，用于衡量资源拦截节省的流量
+BANNER_PNG = make_png(256, 256)
+
+SERVER_PAGE = """<!DOCTYPE html>
+<html lang="ko">
+<head>
+<meta charset="utf-8">
+<title>Weirdhost - {server_id}</title>
+<style>
+  body {{ margin: 0; font-family: sans-serif; }}
+  #sidebar {{ position: fixed; left: 0; top: 0; width: 180px; height: 100%; background: #222; padding: 20px; }}
+  #sidebar button {{ width: 140px; height: 40px; }}
+  #main {{ margin-left: 240px; padding: 20px; }}
+  #overlay {{ display: none; position: fixed; inset: 0; background: rgba(0,0,0,.5); }}
+  #popup {{ position: absolute; left: 560px; top: 240px; width: 420px; padding: 24px; background: #fff; }}
+  #turnstile-box {{ width: 300px; height: 65px; overflow: hidden; }}
+  #turnstile-box iframe {{ width: 300px; height: 65px; border: 0; }}
+  #result {{ display: none; position: fixed; left: 560px; top: 240px; width: 420px; padding: 24px; background: #fff; }}
+</style>
+</head>
+<body>
+<div id="sidebar"><img src="/static/banner.png" width="140" alt=""><button id="renew"><span>시간추가</span></button></div>
+<div id="main">
+  <h1>{server_id}</h1>
+  <div class="expiry"><span>유통기한</span> <b id="expiry">{expiry}</b></div>
+</div>
+<div id="overlay">
+  <div id="popup">
+    <h3>서버 시간 연장</h3>
+    <div id="turnstile-box"><iframe src="/turnstile?delay={solve_delay}"></iframe></div>
+    <input type="hidden" name="cf-turnstile-response" value="">
+    <button id="confirm"><span>시간추가</span></button>
+  </div>
+</div>
+<div id="result"></div>
+<script>
+  document.getElementById('renew').onclick = function() {{
+    document.getElementById('overlay').style.display = 'block';
+  }};
+  window.addEventListener('message', function(ev) {{
+    if (!ev.data || ev.data.type !== 'turnstile-solved') return;
+    document.querySelector('input[name="cf-turnstile-response"]').value = ev.data.token;
+    fetch('/api/renew/{server_id}', {{method: 'POST'}}).then(function(r) {{ return r.json(); }}).then(function(data) {{
+      if (!data.outcome) return;
+      document.getElementById('overlay').remove();
+      var box = document.getElementById('result');
+      if (data.outcome === 'success') {{
+        box.innerHTML = '<h3>Success</h3><p>서버가 갱신되었습니다.</p><button onclick="location.reload()">NEXT</button>';
+      }} else {{
+        box.innerHTML = '<h3>Error</h3><p>아직 시간을 추가할 수 없습니다.</p><button onclick="location.reload()">NEXT</button>';
+      }}
+      box.style.display = 'block';
+    }});
+  }});
+</script>
+</body>
+</html>
+"""
+
+TURNSTILE_PAGE = """<!DOCTYPE html>
+<html><body style="margin:0;background:#fafafa;cursor:pointer">
+<label style="display:flex;align-items:center;height:65px;padding-left:16px;font:14px sans-serif">
+  <input type="checkbox" style="width:24px;height:24px;margin-right:10px">Verify you are human
+</label>
+<script>
+  document.body.addEventListener('click', function() {
+    setTimeout(function() {
+      parent.postMessage({type: 'turnstile-solved', token: '%s'}, '*');
+    }, %d);
+  }, {once: true});
+</script>
+</body></html>
+"""
+
+
+class FakePanel:
+    def __init__(self, default_outcome="success", expiry_days=1.0, solve_delay_ms=(300, 1500)):
+        self.default_outcome = default_outcome
+        self.expiry_days = expiry_days
+        self.solve_delay_ms = solve_delay_ms
+        self.expiry = {}
+        self.stats = {"pages": 0, "api": 0, "renew": 0, "assets": 0, "telegram": 0}
+
+    def outcome_for(self, server_id):
+        for outcome in OUTCOMES:
+            if server_id.startswith(outcome + "-"):
+                return outcome
+        return self.default_outcome
+
+    def expiry_for(self, server_id):
+        if server_id not in self.expiry:
+            self.expiry[server_id] = datetime.now().replace(microsecond=0) + timedelta(days=self.expiry_days)
+        return self.expiry[server_id]
+
+    def authorized(self, request, server_id):
+        if self.outcome_for(server_id) == "logged_out":
+            return False
+        return any(name.startswith("remember_web") for name in request.cookies)
+
+    async def server_page(self, request):
+        server_id = request.match_info["server_id"]
+        self.stats["pages"] += 1
+        if not self.authorized(request, server_id):
+            raise web.HTTPFound("/auth/login")
+        return web.Response(content_type="text/html", text=SERVER_PAGE.format(
+            server_id=server_id,
+            expiry=self.expiry_for(server_id).strftime("%Y-%m-%d %H:%M:%S"),
+            solve_delay=random.randint(*self.solve_delay_ms),
+        ))
+
+    async def client_api(self, request):
+        server_id = request.match_info["server_id"]
+        self.stats["api"] += 1
+        if not self.authorized(request, server_id):
+            return web.json_response({"errors": [{"code": "AuthenticationException"}]}, status=401)
+        return web.json_response({"object": "server", "attributes": {
+            "identifier": server_id,
+            "expired_at": self.expiry_for(server_id).isoformat(),
+        }})
+
+    async def renew(self, request):
+        server_id = request.match_info["server_id"]
+        self.stats["renew"] += 1
+        outcome = self.outcome_for(server_id)
+        if outcome == "timeout":
+            await asyncio.sleep(3600)
+        if outcome == "success":
+            self.expiry[server_id] = self.expiry_for(server_id) + timedelta(hours=RENEW_HOURS)
+        return web.json_response({"outcome": outcome})
+
+    async def turnstile(self, request):
+        token = "".join(random.choices(string.ascii_letters + string.digits, k=48))
+        delay = int(request.query.get("delay", "500"))
+        return web.Response(content_type="text/html", text=TURNSTILE_PAGE % (token, delay))
+
+    async def banner(self, request):
+        self.stats["assets"] += 1
+        return web.Response(body=BANNER_PNG, content_type="image/png")
+
+    async def login(self, request):
+        return web.Response(content_type="text/html", text="<html><body><h1>Login</h1></body></html>")
+
+    async def index(self, request):
+        return web.Response(content_type="text/html", text="<html><body><h1>Weirdhost</h1></body></html>")
+
+    async def telegram(self, request):
+        self.stats["telegram"] += 1
+        return web.json_response({"ok": True, "result": {"message_id": 1}})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/", self.index)
+        app.router.add_get("/server/{server_id}", self.server_page)
+        app.router.add_get("/api/client/servers/{server_id}", self.client_api)
+        app.router.add_post("/api/renew/{server_id}", self.renew)
+        app.router.add_get("/turnstile", self.turnstile)
+        app.router.add_get("/static/banner.png", self.banner)
+        app.router.add_get("/auth/login", self.login)
+        # Telegram Bot API 替身，配合 TG_API_BASE 使用
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地 weirdhost 面板替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--outcome", choices=OUTCOMES, default="success", help="默认续期结果")
+    parser.add_argument("--expiry-days", type=float, default=1.0, help="新服务器的初始剩余天数")
+    args = parser.parse_args(argv)
+    panel = FakePanel(default_outcome=args.outcome, expiry_days=args.expiry_days)
+    web.run_app(panel.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# scripts/replay_snapshots.py
+#
+# 离线回放页面快照，用当前的 classify_page / classify_popup（页面内判定逻辑的 Python 版本）重新判定，无需浏览器：
+#   SNAPSHOT_FILE=snapshots.jsonl python scripts/weirdhost_renew.py    # 运行时记录快照
+#   python scripts/replay_snapshots.py snapshots.jsonl [更多文件或目录]
+#
+# 带 label 的快照用于计算准确率：续期后自动标注 {"success": true/false}（到期时间是否延长），
+# 也可手工补充字段标注（例如 {"result": "cooldown"}）；
+# 未标注的快照统计与记录时页面内判定不一致的数量，用于评估分类逻辑修改的影响。
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from weirdhost_renew import classify_page, classify_popup  # noqa: E402
+
+CLASSIFIERS = {"page": classify_page, "popup": classify_popup}
+
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.endswith(".jsonl"):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def iter_entries(paths):
+    for path in iter_files(paths):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("kind") in CLASSIFIERS and entry.get("snapshot"):
+                    yield entry
+
+
+def outcome(predicted, field):
+    """success 标注对应「判定结果是否为 success」，其余标注直接比较同名字段"""
+    if field == "success":
+        return predicted.get("result") == "success"
+    return predicted.get(field)
+
+
+def replay(entries):
+    stats = {"snapshots": 0, "changed": 0, "total": Counter(), "correct": Counter(), "confusion": Counter()}
+    mismatches = []
+    changes = []
+    for entry in entries:
+        stats["snapshots"] += 1
+        kind = entry["kind"]
+        predicted = CLASSIFIERS[kind](entry["snapshot"])
+        label = entry.get("label")
+        if label:
+            for field, expected in label.items():
+                got = outcome(predicted, field)
+                key = f"{kind}.{field}"
+                stats["total"][key] += 1
+                stats["confusion"][(key, str(expected), str(got))] += 1
+                if got == expected:
+                    stats["correct"][key] += 1
+                else:
+                    mismatches.append((key, expected, got, entry))
+        elif not entry.get("relabel"):
+            recorded = entry.get("predicted") or {}
+            diff = {k: (v, predicted.get(k)) for k, v in recorded.items() if predicted.get(k) != v}
+            if diff:
+                stats["changed"] += 1
+                changes.append((diff, entry))
+    return stats, mismatches, changes
+
+
+def describe(entry):
+    snapshot = entry["snapshot"]
+    text = " ".join((snapshot.get("text") or "").split())[:120]
+    return f"[{entry.get('ts', '')} 账号 {entry.get('account')}] {snapshot.get('url', '')} | {text}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线回放页面快照并评估分类准确率")
+    parser.add_argument("paths", nargs="+", help="快照 JSONL 文件或目录")
+    parser.add_argument("--show", type=int, default=5, help="显示前 N 个错误/变化样本")
+    parser.add_argument("--json", help="把统计结果另存为 JSON")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    stats, mismatches, changes = replay(iter_entries(args.paths))
+    elapsed = time.perf_counter() - start
+    rate = stats["snapshots"] / elapsed if elapsed > 0 else 0
+
+    print(f"[Replay] {stats['snapshots']} 个快照，耗时 {elapsed:.2f}s ({rate:.0f} 个/秒)")
+    accuracy = {}
+    for key in sorted(stats["total"]):
+        accuracy[key] = stats["correct"][key] / stats["total"][key]
+        print(f"  {key:<20} 准确率 {accuracy[key]:6.1%}  ({stats['correct'][key]}/{stats['total'][key]})")
+    if stats["confusion"]:
+        print("\n  字段                 标注         判定         数量")
+        for (key, expected, got), n in sorted(stats["confusion"].items()):
+            print(f"  {key:<20} {expected:<12} {got:<12} {n}")
+    print(f"\n[Replay] 未标注快照中与记录时判定不一致: {stats['changed']}")
+
+    for key, expected, got, entry in mismatches[:args.show]:
+        print(f"  ✗ {key} 标注 {expected} 判定 {got} {describe(entry)}")
+    for diff, entry in changes[:args.show]:
+        detail = ", ".join(f"{k}: {old} -> {new}" for k, (old, new) in diff.items())
+        print(f"  ~ {detail} {describe(entry)}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "snapshots": stats["snapshots"], "seconds": elapsed, "changed": stats["changed"],
+                "accuracy": accuracy, "mismatches": len(mismatches),
+            }, f, indent=1, ensure_ascii=False)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
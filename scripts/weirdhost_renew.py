@@ -6,26 +6,178 @@ import os
 import time
 import asyncio
 import aiohttp
+import argparse
 import base64
 import random
 import re
+import shutil
+import sys
 import subprocess
 import json
+import queue
+import threading
+import hashlib
+import io
+import math
+import heapq
+import functools
+import weakref
+import multiprocessing
+import contextlib
+import atexit
+import tarfile
+import tempfile
+from collections import Counter
 from datetime import datetime, timedelta
-from urllib.parse import unquote
+from urllib.parse import unquote, urlsplit
+
+from yarl import URL
 
 from seleniumbase import SB
 
 try:
     from nacl import encoding, public
+    from nacl.exceptions import CryptoError
+    from nacl.secret import SecretBox
     NACL_AVAILABLE = True
 except ImportError:
     NACL_AVAILABLE = False
 
-BASE_URL = "https://hub.weirdhost.xyz/server/"
-DOMAIN = "hub.weirdhost.xyz"
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    from Xlib import X, display as xdisplay
+    from Xlib.ext import xtest
+    XLIB_AVAILABLE = True
+except ImportError:
+    XLIB_AVAILABLE = False
+
+ORIGIN = os.environ.get("WEIRDHOST_ORIGIN", "https://hub.weirdhost.xyz").rstrip("/")
+BASE_URL = f"{ORIGIN}/server/"
+DOMAIN = urlsplit(ORIGIN).hostname
 
 RENEW_THRESHOLD_DAYS = int(os.environ.get("RENEW_THRESHOLD_DAYS", "2"))
+WORKERS = int(os.environ.get("WORKERS", "1"))
+HTTP_PROBE = os.environ.get("HTTP_PROBE", "1") != "0"
+HTTP_PROBE_CONCURRENCY = int(os.environ.get("HTTP_PROBE_CONCURRENCY", "8"))
+HTTP_PROBE_TIMEOUT = int(os.environ.get("HTTP_PROBE_TIMEOUT", "15"))
+
+STATE_DIR = os.environ.get("STATE_DIR", ".weirdhost_state")
+STATE_FILE = os.path.join(STATE_DIR, "state.json")
+# 加密账号库：一个密文包含全部账号和 Cookie，用 VAULT_KEY 解密
+ACCOUNT_VAULT = os.environ.get("ACCOUNT_VAULT", "").strip()
+ACCOUNT_VAULT_FILE = os.environ.get("ACCOUNT_VAULT_FILE", "").strip()
+VAULT_KEY = os.environ.get("VAULT_KEY", "").strip()
+VAULT_SECRET_NAME = os.environ.get("VAULT_SECRET_NAME", "ACCOUNT_VAULT")
+
+# 每个账号完成后追加写入检查点，--resume 时跳过窗口期内已完成的账号
+CHECKPOINT_FILE = os.path.join(STATE_DIR, "checkpoint.jsonl")
+CHECKPOINT_WINDOW_HOURS = float(os.environ.get("CHECKPOINT_WINDOW_HOURS", "12"))
+BROWSER_MAX_RESTARTS = int(os.environ.get("BROWSER_MAX_RESTARTS", "3"))
+
+# 运行历史：每次运行追加一行紧凑 JSON，供 --report 统计耗时分位、成功率和最低剩余天数
+HISTORY_FILE = os.path.join(STATE_DIR, "history.jsonl")
+HISTORY_KEEP_DAYS = int(os.environ.get("HISTORY_KEEP_DAYS", "365"))
+HISTORY_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+STATE_SKIP_MARGIN_DAYS = float(os.environ.get("STATE_SKIP_MARGIN_DAYS", "1"))
+
+SCREENSHOT_HASH_DISTANCE = int(os.environ.get("SCREENSHOT_HASH_DISTANCE", "2"))
+
+COOKIE_INJECTION = os.environ.get("COOKIE_INJECTION", "cdp").lower()
+
+PAGE_WAIT_TIMEOUT = float(os.environ.get("PAGE_WAIT_TIMEOUT", "12"))
+PAGE_WAIT_POLL = 0.1
+
+TG_API_BASE = os.environ.get("TG_API_BASE", "https://api.telegram.org")
+# Telegram 按 UTF-16 长度限制消息 4096、图片说明 1024，留出余量
+TG_MESSAGE_LIMIT = 4000
+TG_CAPTION_LIMIT = 1024
+
+STATUS_ICONS = {
+    "success": "✅",
+    "cooldown": "⏳",
+    "skipped": "⏭️",
+    "error": "❌",
+    "timeout": "⚠️"
+}
+
+TURNSTILE_STATS_FILE = os.path.join(STATE_DIR, "turnstile.json")
+TURNSTILE_HISTORY_LIMIT = 300
+TURNSTILE_MIN_SAMPLES = 5
+TURNSTILE_OFFSETS = (30, 24, 36, 18, 42)
+
+# 无头模式：Chrome 以 --headless=new 运行，不需要 Xvfb；没有显示服务器，只能用 CDP 派发输入
+HEADLESS = os.environ.get("HEADLESS", "0") == "1"
+INPUT_BACKEND = "cdp" if HEADLESS else os.environ.get("INPUT_BACKEND", "auto").lower()
+
+PERSIST_PROFILES = os.environ.get("PERSIST_PROFILES", "0") == "1"
+PROFILE_ARCHIVE_DIR = os.path.join(STATE_DIR, "profiles")
+PROFILE_MAX_MB = int(os.environ.get("PROFILE_MAX_MB", "80"))
+# 体积超限时按顺序删除的缓存目录（优先保留 Cookie / Local Storage）
+PROFILE_PRUNE_DIRS = [
+    "Default/Service Worker/CacheStorage",
+    "Default/Code Cache",
+    "Default/Cache",
+    "Default/GPUCache",
+]
+PROFILE_VOLATILE = [
+    "SingletonLock", "SingletonCookie", "SingletonSocket",
+    "Crash Reports", "ShaderCache", "GrShaderCache", "GraphiteDawnCache", "component_crx_cache",
+]
+# Cookie 库在 Linux 上几乎是明文，Actions 缓存可被 fork PR 恢复：设置 VAULT_KEY 时整个归档用 SecretBox 加密，否则不归档这些文件
+PROFILE_SECRET_FILES = [
+    "Default/Cookies", "Default/Cookies-journal",
+    "Default/Network/Cookies", "Default/Network/Cookies-journal",
+    "Default/Login Data", "Default/Login Data-journal",
+]
+
+# 运行内重试：失败的账号在其余账号处理完后按状态退避重试，直到超出时间预算
+RUN_STARTED = time.time()
+RUN_BUDGET_MINUTES = float(os.environ.get("RUN_BUDGET_MINUTES", "20"))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_DELAYS = {"error": 60, "timeout": 120, "unknown": 120, "cooldown": 600}
+RETRY_ACCOUNT_ESTIMATE = 120
+
+DAEMON_MARGIN_HOURS = float(os.environ.get("DAEMON_MARGIN_HOURS", str(RENEW_THRESHOLD_DAYS * 24 - 1)))
+DAEMON_JITTER_MINUTES = float(os.environ.get("DAEMON_JITTER_MINUTES", "20"))
+DAEMON_RETRY_MINUTES = float(os.environ.get("DAEMON_RETRY_MINUTES", "30"))
+DAEMON_COOLDOWN_HOURS = float(os.environ.get("DAEMON_COOLDOWN_HOURS", "2"))
+DAEMON_BATCH_WINDOW = 120
+DAEMON_MAX_SLEEP = 3600
+
+# 状态变化时的页面快照（含完整页面文本），留空不记录；供 scripts/replay_snapshots.py 回放
+SNAPSHOT_FILE = os.environ.get("SNAPSHOT_FILE", "")
+
+TRACE_FILE = os.environ.get("TRACE_FILE", "weirdhost_trace.json")
+
+HTTP_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+EXPIRY_LABEL_RE = re.compile(r'유통기한(?:\s|<[^>]*>|:)*(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})')
+EXPIRY_ANY_RE = re.compile(r'(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})')
+
+# 资源策略：lean 时用 declarativeNetRequest 扩展拦截图片/字体/媒体和第三方统计、字体域名，
+# observe 时只统计 lean 会拦截的请求及其大小而不拦截；Turnstile 所在域名及其发起的请求始终放行
+RESOURCE_POLICY = os.environ.get("RESOURCE_POLICY", "off").lower()
+# observe 模式下学到的被拦截资源大小，lean 模式据此估算节省的流量
+RESOURCE_SIZES_FILE = os.path.join(STATE_DIR, "resource_sizes.json")
+RESOURCE_SIZES_LIMIT = 2000
+RESOURCE_BLOCK_TYPES = ["image", "font", "media"]
+RESOURCE_BLOCK_DOMAINS = [
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net", "googlesyndication.com",
+    "facebook.net", "hotjar.com", "clarity.ms", "fonts.googleapis.com", "fonts.gstatic.com",
+]
+RESOURCE_BLOCK_EXTRA = [d.strip() for d in os.environ.get("RESOURCE_BLOCK_EXTRA", "").split(",") if d.strip()]
+RESOURCE_ALWAYS_ALLOW = ["challenges.cloudflare.com"]
+
+# 每个账号使用独立的 CDP 浏览器上下文（共用一个 Chrome），并在处理当前账号时预加载下一个账号
+BROWSER_CONTEXTS = os.environ.get("BROWSER_CONTEXTS", "0") == "1"
+CONTEXT_PREFETCH = os.environ.get("CONTEXT_PREFETCH", "1") != "0"
+
+CHROMIUM_ARGS = "--disable-dev-shm-usage,--no-sandbox,--disable-gpu,--disable-software-rasterizer,--disable-background-timer-throttling"
 
 
 def mask_sensitive(text, show_chars=3):
@@ -67,7 +219,14 @@ def mask_url(url):
 
 
 def parse_accounts():
-    """解析 ACCOUNTS 环境变量"""
+    """解析 ACCOUNTS 环境变量；配置了账号库时改为从账号库读取"""
+    if ACCOUNT_VAULT or ACCOUNT_VAULT_FILE:
+        vault = get_vault()
+        if not vault:
+            return []
+        print(f"[+] 账号库解析到 {len(vault.accounts)} 个有效账号配置")
+        return vault.public_accounts()
+
     accounts_str = os.environ.get("ACCOUNTS", "").strip()
     
     if not accounts_str:
@@ -132,6 +291,215 @@ def build_server_url(server_id):
     return server_id if server_id.startswith("http") else f"{BASE_URL}{server_id}"
 
 
+@functools.lru_cache(maxsize=1)
+def load_secrets_json():
+    """解析 SECRETS_JSON（工作流中传入 toJSON(secrets)），账号多时无需逐个映射 Cookie 变量"""
+    try:
+        secrets = json.loads(os.environ.get("SECRETS_JSON", "") or "{}")
+    except json.JSONDecodeError:
+        print("[!] SECRETS_JSON 不是合法的 JSON，已忽略")
+        return {}
+    return secrets if isinstance(secrets, dict) else {}
+
+
+class AccountVault:
+    """加密账号库：账号与 Cookie 整体用 SecretBox 加密，轮换后整体重新加密、一次写回"""
+
+    def __init__(self, accounts, key):
+        self.accounts = accounts
+        self.key = key
+        self.rotations = {}
+        self.dirty = False
+
+    @staticmethod
+    def validate(accounts):
+        """返回错误列表；每个账号需要字符串类型的 id 和 cookie，且 id 不能重复"""
+        if isinstance(accounts, dict):
+            accounts = accounts.get("accounts")
+        if not isinstance(accounts, list) or not accounts:
+            return ["账号库内容应为非空 JSON 数组"]
+        errors = []
+        seen = set()
+        for i, acc in enumerate(accounts):
+            if not isinstance(acc, dict):
+                errors.append(f"账号 {i+1} 不是对象")
+                continue
+            wrong_type = [
+                field for field in ("id", "cookie", "remark")
+                if field in acc and acc[field] is not None and not isinstance(acc[field], str)
+            ]
+            if wrong_type:
+                errors.append(f"账号 {i+1} 的字段应为字符串: {', '.join(wrong_type)}")
+                continue
+            missing = [field for field in ("id", "cookie") if not (acc.get(field) or "").strip()]
+            if missing:
+                errors.append(f"账号 {i+1} 缺少必要字段: {', '.join(missing)}")
+            elif acc["id"].strip() in seen:
+                errors.append(f"账号 {i+1} 的 id 重复")
+            seen.add((acc.get("id") or "").strip())
+        return errors
+
+    @staticmethod
+    def seal(data, key):
+        box = SecretBox(base64.b64decode(key))
+        plaintext = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        return base64.b64encode(box.encrypt(plaintext)).decode("ascii")
+
+    @staticmethod
+    def unseal(blob, key):
+        box = SecretBox(base64.b64decode(key))
+        return json.loads(box.decrypt(base64.b64decode(blob)).decode("utf-8"))
+
+    @classmethod
+    def open(cls, blob, key):
+        accounts = cls.unseal(blob, key)
+        if isinstance(accounts, dict):
+            accounts = accounts.get("accounts")
+        return cls(accounts, key)
+
+    def public_accounts(self):
+        """不含 Cookie 的账号列表，Cookie 通过 get_account_cookie 按 server_id 查找"""
+        return [
+            {**{k: v for k, v in acc.items() if k != "cookie"}, "vault": True}
+            for acc in self.accounts
+        ]
+
+    def cookie_for(self, server_id):
+        for acc in self.accounts:
+            if acc["id"].strip() == server_id:
+                return acc["cookie"]
+        return ""
+
+    def update_cookie(self, server_id, cookie):
+        for acc in self.accounts:
+            if acc["id"].strip() == server_id and acc["cookie"] != cookie:
+                acc["cookie"] = cookie
+                self.rotations[server_id] = cookie
+                self.dirty = True
+                return True
+        return False
+
+    def commit(self):
+        """把轮换后的账号库重新加密写回：文件模式写文件，环境变量模式更新一个 Secret"""
+        if not self.dirty:
+            return True
+        blob = self.seal(self.accounts, self.key)
+        if ACCOUNT_VAULT_FILE:
+            tmp_path = ACCOUNT_VAULT_FILE + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(blob + "\n")
+                os.replace(tmp_path, ACCOUNT_VAULT_FILE)
+                ok = True
+            except OSError as e:
+                print(f"[账号库] 写入 {ACCOUNT_VAULT_FILE} 失败: {e}")
+                ok = False
+        else:
+            ok = asyncio.run(update_github_secrets({VAULT_SECRET_NAME: blob}))[VAULT_SECRET_NAME]
+        if ok:
+            self.rotations = {}
+            self.dirty = False
+        return ok
+
+
+@functools.lru_cache(maxsize=1)
+def get_vault():
+    """首次使用时读取并解密账号库，只校验一次；未配置或无效时返回 None"""
+    if not (ACCOUNT_VAULT or ACCOUNT_VAULT_FILE):
+        return None
+    if not NACL_AVAILABLE or not VAULT_KEY:
+        print("❌ 错误: 使用账号库需要安装 pynacl 并设置 VAULT_KEY")
+        return None
+    blob = ACCOUNT_VAULT
+    if ACCOUNT_VAULT_FILE:
+        try:
+            with open(ACCOUNT_VAULT_FILE, "r", encoding="utf-8") as f:
+                blob = f.read().strip()
+        except OSError as e:
+            print(f"❌ 错误: 无法读取账号库文件 {ACCOUNT_VAULT_FILE}: {e}")
+            return None
+    try:
+        vault = AccountVault.open(blob, VAULT_KEY)
+    except (CryptoError, ValueError, TypeError) as e:
+        print(f"❌ 错误: 账号库解密失败（密钥错误或内容损坏）: {type(e).__name__}")
+        return None
+    errors = AccountVault.validate(vault.accounts)
+    for error in errors:
+        print(f"[!] 账号库: {error}")
+    return None if errors else vault
+
+
+def seal_vault(path):
+    """把明文账号 JSON（含 cookie 字段）加密成账号库密文；未设置 VAULT_KEY 时生成新密钥"""
+    with (sys.stdin if path == "-" else open(path, "r", encoding="utf-8")) as f:
+        accounts = json.load(f)
+    errors = AccountVault.validate(accounts)
+    if errors:
+        for error in errors:
+            print(f"[!] {error}")
+        return
+    key = VAULT_KEY or base64.b64encode(os.urandom(SecretBox.KEY_SIZE)).decode("ascii")
+    if not VAULT_KEY:
+        print(f"VAULT_KEY={key}")
+    print(f"ACCOUNT_VAULT={AccountVault.seal(accounts, key)}")
+
+
+def get_account_cookie(account):
+    if account.get("probe_cookie"):
+        # HTTP 预检时 remember_web 已轮换，旧 Cookie 可能已失效
+        return account["probe_cookie"]
+    if account.get("vault"):
+        vault = get_vault()
+        return vault.cookie_for(account.get("id", "").strip()) if vault else ""
+    cookie_env = account.get("cookie_env", "").strip()
+    if not cookie_env:
+        return ""
+    return (os.environ.get(cookie_env) or load_secrets_json().get(cookie_env) or "").strip()
+
+
+def parse_shard(value):
+    """解析 --shard i/n（i 从 1 开始）"""
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("格式应为 i/n，例如 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("需要满足 1 <= i <= n")
+    return index, count
+
+
+def shard_of(account, count):
+    """按 server_id 的哈希稳定分片，账号增删不会打乱其他账号所在的分片"""
+    digest = hashlib.sha1(account.get("id", "").strip().encode("utf-8")).hexdigest()
+    return int(digest, 16) % count + 1
+
+
+def select_shard(indexed_accounts, shard):
+    if not shard:
+        return indexed_accounts
+    index, count = shard
+    return [(i, account) for i, account in indexed_accounts if shard_of(account, count) == index]
+
+
+def new_result(account, account_index):
+    remark = account.get("remark", f"账号{account_index + 1}")
+    return {
+        "remark": remark,
+        "display_name": mask_email(remark) if "@" in remark else remark,
+        "server_id": account.get("id", "").strip(),
+        "cookie_env": account.get("cookie_env", "").strip(),
+        "status": "unknown",
+        "original_expiry": "Unknown",
+        "new_expiry": "Unknown",
+        "message": "",
+        "screenshot": None,
+        "cookie_updated": False,
+        "skipped": False,
+        # HTTP 预检拿到的新 Cookie：即使浏览器处理失败或未处理也要提交
+        "rotated_cookie": account.get("probe_cookie"),
+    }
+
+
 def calculate_remaining_time(expiry_str):
     try:
         for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]:
@@ -158,6 +526,7 @@ def calculate_remaining_time(expiry_str):
         return "计算失败"
 
 
+@functools.lru_cache(maxsize=512)
 def parse_expiry_to_datetime(expiry_str):
     if not expiry_str or expiry_str == "Unknown":
         return None
@@ -184,50 +553,594 @@ def should_renew(expiry_str):
     return remaining_days <= RENEW_THRESHOLD_DAYS
 
 
-def random_delay(min_sec=0.5, max_sec=2.0):
-    time.sleep(random.uniform(min_sec, max_sec))
+def load_state():
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if isinstance(state, dict) and isinstance(state.get("servers"), dict):
+            return state
+    except (OSError, ValueError):
+        pass
+    return {"servers": {}}
+
+
+def save_state(state):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp_path = STATE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def update_state(state, results):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for r in results:
+        server_id = r.get("server_id")
+        if not server_id or r.get("from_cache"):
+            continue
+        entry = state["servers"].setdefault(server_id, {})
+        expiry = r.get("new_expiry")
+        if not parse_expiry_to_datetime(expiry):
+            expiry = r.get("original_expiry")
+        if parse_expiry_to_datetime(expiry):
+            entry["last_expiry"] = expiry
+        entry["last_status"] = r.get("status")
+        entry["last_checked"] = now
+        if r.get("cookie_updated"):
+            entry["cookie_rotated_at"] = now
+    return state
+
+
+def state_precheck(state, indexed_accounts):
+    """状态缓存预检：缓存的到期时间仍远超阈值的账号直接跳过，不发任何请求"""
+    skipped = {}
+    remaining = []
+    for i, account in indexed_accounts:
+        entry = state["servers"].get(account.get("id", "").strip(), {})
+        expiry = entry.get("last_expiry")
+        remaining_days = get_remaining_days(expiry)
+        if remaining_days is not None and remaining_days > RENEW_THRESHOLD_DAYS + STATE_SKIP_MARGIN_DAYS:
+            result = new_result(account, i)
+            result.update({
+                "status": "skipped",
+                "skipped": True,
+                "from_cache": True,
+                "original_expiry": expiry,
+                "new_expiry": expiry,
+                "message": f"无需续期 (缓存, 剩余 {remaining_days:.1f} 天)",
+            })
+            skipped[i] = result
+        else:
+            remaining.append((i, account))
+    if skipped:
+        print(f"[缓存] {len(skipped)} 个账号到期时间充足，跳过检查")
+    return skipped, remaining
 
 
-async def tg_notify(message):
-    token = os.environ.get("TG_BOT_TOKEN")
-    chat_id = os.environ.get("TG_CHAT_ID")
-    if not token or not chat_id:
-        print("[TG] 未配置 TG_BOT_TOKEN 或 TG_CHAT_ID，跳过通知")
+def reset_checkpoint():
+    try:
+        os.remove(CHECKPOINT_FILE)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"[检查点] 清理失败: {e}")
+
+
+def append_checkpoint(index, result):
+    """账号结果一完成就追加一行，进程或机器崩溃也不会丢失已完成的账号。
+    Cookie 值不写入检查点，只记录是否有尚未提交的轮换"""
+    record = {k: v for k, v in result.items() if k not in ("rotated_cookie", "waits")}
+    record["rotation_pending"] = bool(result.get("rotated_cookie"))
+    line = json.dumps({
+        "index": index,
+        "server_id": result.get("server_id"),
+        "written_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "result": record,
+    }, ensure_ascii=False, default=str)
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(CHECKPOINT_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        print(f"[检查点] 写入失败: {e}")
+
+
+def mark_checkpoint_recorded():
+    """运行结束、历史和 Turnstile 统计写入后追加一行标记：之前的结果在 --resume 时不再重复统计"""
+    try:
+        with open(CHECKPOINT_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"recorded": True, "written_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}) + "\n")
+    except OSError as e:
+        print(f"[检查点] 写入失败: {e}")
+
+
+def unrecorded(results):
+    """未写入历史/统计的结果：从检查点恢复、且中断前的运行已完成统计的结果除外"""
+    return [r for r in results if not r.get("stats_recorded")]
+
+
+def load_checkpoint(indexed_accounts):
+    """读取窗口期内的检查点，返回 (已完成的结果 {index: result}, 仍需处理的账号)"""
+    latest = {}
+    cutoff = datetime.now() - timedelta(hours=CHECKPOINT_WINDOW_HOURS)
+    try:
+        with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    written_at = datetime.strptime(entry["written_at"], "%Y-%m-%d %H:%M:%S")
+                except (ValueError, KeyError, TypeError):
+                    # 崩溃时可能留下写了一半的最后一行
+                    continue
+                if entry.get("recorded"):
+                    # 标记之前的结果已由当时的运行写入历史和统计
+                    for result in latest.values():
+                        result["stats_recorded"] = True
+                elif written_at >= cutoff and entry.get("server_id"):
+                    latest[entry["server_id"]] = entry["result"]
+    except FileNotFoundError:
+        return {}, indexed_accounts
+    except OSError as e:
+        print(f"[检查点] 读取失败: {e}")
+        return {}, indexed_accounts
+
+    done = {}
+    remaining = []
+    for i, account in indexed_accounts:
+        result = latest.get(account.get("id", "").strip())
+        # 失败的账号重新处理，只跳过已有确定结果的账号；
+        # 轮换后的 Cookie 尚未提交就崩溃的账号也重新处理，否则新 Cookie 永久丢失
+        if result and result.get("status") not in ("error", "timeout", "unknown") and not result.get("rotation_pending"):
+            result["resumed"] = True
+            done[i] = result
+        else:
+            remaining.append((i, account))
+    if done:
+        print(f"[检查点] 恢复 {len(done)} 个已完成账号，剩余 {len(remaining)} 个")
+    return done, remaining
+
+
+def history_entry(result, now=None):
+    """单个账号结果压缩成短键记录：s 状态, d 耗时, h 延长小时, m 运行时剩余天数, a 尝试次数"""
+    entry = {"id": result.get("server_id"), "s": result.get("status")}
+    if result.get("duration") is not None:
+        entry["d"] = result["duration"]
+    if result.get("added_hours") is not None:
+        entry["h"] = result["added_hours"]
+    expiry_dt = parse_expiry_to_datetime(result.get("original_expiry"))
+    if expiry_dt:
+        entry["m"] = round((expiry_dt - (now or datetime.now())).total_seconds() / 86400, 2)
+    if result.get("attempts", 1) > 1:
+        entry["a"] = result["attempts"]
+    if result.get("from_cache") or result.get("resumed"):
+        entry["c"] = 1
+    return entry
+
+
+def record_run_history(results):
+    """追加一行本次运行的历史；键顺序固定，时间戳始终位于行首，--report 可直接二分定位。
+    从检查点恢复、已由中断前的运行写入过的结果不重复记录"""
+    results = unrecorded(results)
+    if not results:
         return
-    async with aiohttp.ClientSession() as session:
-        try:
-            await session.post(
-                f"https://api.telegram.org/bot{token}/sendMessage",
-                json={"chat_id": chat_id, "text": message, "parse_mode": "HTML"}
-            )
-        except Exception as e:
-            print(f"[TG] 发送失败: {e}")
+    now = datetime.now()
+    line = json.dumps({
+        "t": now.strftime(HISTORY_TIME_FORMAT),
+        "r": [history_entry(r, now) for r in results],
+    }, ensure_ascii=False, separators=(",", ":"), default=str)
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+        prune_history(now - timedelta(days=HISTORY_KEEP_DAYS))
+    except OSError as e:
+        print(f"[历史] 写入失败: {e}")
+
+
+def history_time(line):
+    """取行首的时间戳而不解析整行，格式不符时返回 None"""
+    if line.startswith(b'{"t":"') and len(line) >= 25:
+        return line[6:25].decode("ascii", "replace")
+    return None
+
+
+def seek_history(f, since):
+    """二分查找第一条时间戳 >= since 的行，f 为二进制模式打开的历史文件"""
+    f.seek(0, os.SEEK_END)
+    lo, hi = 0, f.tell()
+    while lo < hi:
+        mid = (lo + hi) // 2
+        f.seek(mid - 1 if mid else 0)
+        if mid:
+            f.readline()
+        line = f.readline()
+        t = history_time(line)
+        if line and (t is None or t < since):
+            lo = mid + 1
+        else:
+            hi = mid
+    f.seek(lo - 1 if lo else 0)
+    if lo:
+        f.readline()
+
+
+def iter_history(path, since=None, until=None):
+    """按时间窗口逐行读取历史，窗口之外的行不做 JSON 解析"""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        if since:
+            seek_history(f, since)
+        for line in f:
+            t = history_time(line)
+            if until and t and t > until:
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # 崩溃时可能留下写了一半的最后一行
+                continue
+
+
+def prune_history(cutoff):
+    """最早一条超出保留期一个月以上时，丢弃保留期之前的行，避免每次运行都重写文件"""
+    with open(HISTORY_FILE, "rb") as f:
+        first = history_time(f.readline())
+        if not first or first >= (cutoff - timedelta(days=30)).strftime(HISTORY_TIME_FORMAT):
+            return
+        seek_history(f, cutoff.strftime(HISTORY_TIME_FORMAT))
+        kept = f.read()
+    tmp_path = HISTORY_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(kept)
+    os.replace(tmp_path, HISTORY_FILE)
+    print(f"[历史] 已清理 {HISTORY_KEEP_DAYS} 天之前的记录")
+
+
+def summarize_history(runs):
+    """汇总运行历史：状态计数、浏览器耗时分位、平均延长小时和最低剩余天数"""
+    statuses = Counter()
+    durations = []
+    added = []
+    margins = {}
+    summary = {"runs": 0, "first": None, "last": None}
+    for run in runs:
+        summary["runs"] += 1
+        summary["first"] = summary["first"] or run.get("t")
+        summary["last"] = run.get("t")
+        for entry in run.get("r", []):
+            statuses[entry.get("s")] += 1
+            if entry.get("d") is not None and not entry.get("c"):
+                durations.append(entry["d"])
+            if entry.get("h") is not None:
+                added.append(entry["h"])
+            margin = entry.get("m")
+            server_id = entry.get("id")
+            if margin is not None and (server_id not in margins or margin < margins[server_id][0]):
+                margins[server_id] = (margin, run.get("t"))
+    attempted = sum(n for s, n in statuses.items() if s != "skipped")
+    summary.update({
+        "results": sum(statuses.values()),
+        "statuses": dict(statuses.most_common()),
+        "success_rate": statuses["success"] / attempted if attempted else None,
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "browser_runs": len(durations),
+        "avg_added_hours": sum(added) / len(added) if added else None,
+        "lowest_margins": sorted(
+            ({"server_id": k, "days": v[0], "at": v[1]} for k, v in margins.items()),
+            key=lambda m: m["days"]),
+    })
+    return summary
+
+
+def print_history_report(paths=None, days=None, since=None, until=None, top=5, json_path=None):
+    """--report：统计时间窗口内的运行历史"""
+    if days and not since:
+        since = (datetime.now() - timedelta(days=days)).strftime(HISTORY_TIME_FORMAT)
+    paths = paths or [HISTORY_FILE]
+    start = time.perf_counter()
+    summary = summarize_history(run for path in paths for run in iter_history(path, since, until))
+    elapsed = time.perf_counter() - start
+
+    if not summary["runs"]:
+        print(f"[历史] 窗口内没有运行记录 ({', '.join(paths)})")
+        return summary
+    print(f"[历史] {summary['first']} ~ {summary['last']}: {summary['runs']} 次运行, "
+          f"{summary['results']} 个账号结果 (耗时 {elapsed:.2f}s)")
+    for status, n in summary["statuses"].items():
+        print(f"  {STATUS_ICONS.get(status, '❓')} {status:<10} {n:>6}  {n / summary['results']:6.1%}")
+    if summary["success_rate"] is not None:
+        print(f"  成功率 (不含跳过): {summary['success_rate']:.1%}")
+    if summary["browser_runs"]:
+        print(f"  浏览器耗时: p50 {summary['p50']:.1f}s, p95 {summary['p95']:.1f}s ({summary['browser_runs']} 次)")
+    if summary["avg_added_hours"] is not None:
+        print(f"  平均延长: {summary['avg_added_hours']:.1f} 小时")
+    if summary["lowest_margins"]:
+        print("  最低剩余天数:")
+        for m in summary["lowest_margins"][:top]:
+            print(f"    {m['server_id']:<20} {m['days']:>6.2f} 天  @ {m['at']}")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=1)
+    return summary
+
+
+def percentile(values, pct):
+    """线性插值百分位，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
 
+def random_delay(min_sec=0.5, max_sec=2.0):
+    time.sleep(random.uniform(min_sec, max_sec))
 
-async def tg_notify_photo(photo_path, caption=""):
-    token = os.environ.get("TG_BOT_TOKEN")
-    chat_id = os.environ.get("TG_CHAT_ID")
-    if not token or not chat_id or not os.path.exists(photo_path):
+
+class Tracer:
+    """耗时埋点：span/step 记录为 Chrome trace 事件，并统计每个 span 内的 WebDriver 命令数"""
+
+    def __init__(self):
+        self.events = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._t0 = time.time() - time.perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.collectors = []
+        return self._local.stack
+
+    def _push(self, name, kind, args):
+        entry = {"name": name, "kind": kind, "start": time.perf_counter(),
+                 "commands": 0, "scripts": 0, "args": args}
+        self._stack().append(entry)
+        return entry
+
+    def _finish(self, entry):
+        end = time.perf_counter()
+        dur = end - entry["start"]
+        args = dict(entry["args"])
+        args.update(webdriver_commands=entry["commands"], execute_script=entry["scripts"])
+        event = {
+            "name": entry["name"], "cat": entry["kind"], "ph": "X",
+            "ts": int((self._t0 + entry["start"]) * 1e6), "dur": int(dur * 1e6),
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+        for timings in self._local.collectors:
+            slot = timings.setdefault(entry["name"], {"seconds": 0.0, "commands": 0, "scripts": 0})
+            slot["seconds"] += dur
+            slot["commands"] += entry["commands"]
+            slot["scripts"] += entry["scripts"]
+
+    def _close_steps(self, until=None):
+        stack = self._stack()
+        while stack and stack[-1] is not until and stack[-1]["kind"] == "step":
+            self._finish(stack.pop())
+
+    @contextlib.contextmanager
+    def span(self, name, collect=None, **args):
+        """collect 传入 dict 时，span 内所有子 span/step 的耗时会累计到该 dict"""
+        entry = self._push(name, "span", args)
+        if collect is not None:
+            self._local.collectors.append(collect)
+        try:
+            yield entry
+        finally:
+            self._close_steps(until=entry)
+            stack = self._stack()
+            if stack and stack[-1] is entry:
+                stack.pop()
+            self._finish(entry)
+            if collect is not None:
+                self._local.collectors.remove(collect)
+
+    def step(self, name, **args):
+        """结束当前层级上一个 step 并开始新的 step，适合顺序执行的步骤"""
+        stack = self._stack()
+        if stack and stack[-1]["kind"] == "step":
+            self._finish(stack.pop())
+        self._push(name, "step", args)
+
+    def count_command(self, command):
+        is_script = "executescript" in str(command).lower()
+        for entry in self._stack():
+            entry["commands"] += 1
+            if is_script:
+                entry["scripts"] += 1
+
+    def write(self, path, extra_events=()):
+        events = list(self.events) + list(extra_events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        print(f"[Trace] 已写入 {path} ({len(events)} 个事件)")
+
+
+TRACER = Tracer()
+
+
+def install_webdriver_counter():
+    """所有 WebDriver 命令都经过 WebDriver.execute，在此处计数"""
+    from selenium.webdriver.remote.webdriver import WebDriver
+    if getattr(WebDriver.execute, "_traced", False):
         return
-    async with aiohttp.ClientSession() as session:
+    original = WebDriver.execute
+
+    def execute(self, driver_command, params=None):
+        TRACER.count_command(driver_command)
+        return original(self, driver_command, params)
+
+    execute._traced = True
+    WebDriver.execute = execute
+
+
+class TelegramNotifier:
+    """长连接 Telegram 通知：单个会话 + 后台发送队列，支持进度消息原地编辑和 429 重试"""
+
+    MAX_RETRIES = 4
+    READY_TIMEOUT = 10
+
+    def __init__(self, token=None, chat_id=None, api_base=None):
+        self.token = token if token is not None else os.environ.get("TG_BOT_TOKEN")
+        self.chat_id = chat_id if chat_id is not None else os.environ.get("TG_CHAT_ID")
+        self.api_base = (api_base or TG_API_BASE).rstrip("/")
+        self.enabled = bool(self.token and self.chat_id)
+        self.status_message_id = None
+        self._edit_seq = 0
+        self._ready = threading.Event()
+        self._loop = None
+        self._outbox = None
+        self._session = None
+        self._thread = None
+        if not self.enabled:
+            print("[TG] 未配置 TG_BOT_TOKEN 或 TG_CHAT_ID，跳过通知")
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout=self.READY_TIMEOUT) or not self.enabled:
+            # 发送线程没能建立会话时关闭通知，不阻塞续期
+            print("[TG] 通知线程启动失败，本次不发送通知")
+            self.enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
         try:
-            with open(photo_path, "rb") as f:
+            self._loop.run_until_complete(self._main())
+        except Exception as e:
+            print(f"[TG] 通知线程异常退出: {e}")
+        finally:
+            self.enabled = False
+            self._ready.set()
+            self._loop.close()
+
+    async def _main(self):
+        self._outbox = asyncio.Queue()
+        connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=120)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+            self._session = session
+            self._ready.set()
+            while True:
+                item = await self._outbox.get()
+                if item is None:
+                    break
+                kind, payload = item
+                try:
+                    if kind == "edit":
+                        seq, text = payload
+                        if seq != self._edit_seq:
+                            continue
+                        await self._edit_status(text)
+                    elif kind == "status":
+                        body = await self._call("sendMessage", json=self._text_payload(payload))
+                        if body and body.get("ok"):
+                            self.status_message_id = body["result"]["message_id"]
+                    elif kind == "photo":
+                        await self._call("sendPhoto", form=payload)
+                    else:
+                        await self._call("sendMessage", json=self._text_payload(payload))
+                except Exception as e:
+                    print(f"[TG] 发送失败: {e}")
+
+    def _text_payload(self, text):
+        return {"chat_id": self.chat_id, "text": text, "parse_mode": "HTML"}
+
+    async def _edit_status(self, text):
+        if self.status_message_id is None:
+            return
+        payload = self._text_payload(text)
+        payload["message_id"] = self.status_message_id
+        await self._call("editMessageText", json=payload)
+
+    async def _call(self, method, json=None, form=None):
+        with TRACER.span(f"telegram.{method}"):
+            return await self._call_api(method, json, form)
+
+    async def _call_api(self, method, json, form):
+        url = f"{self.api_base}/bot{self.token}/{method}"
+        delay = 1
+        for attempt in range(self.MAX_RETRIES):
+            data = None
+            if form is not None:
+                photo_path, caption = form
                 data = aiohttp.FormData()
-                data.add_field("chat_id", chat_id)
-                data.add_field("photo", f, filename=os.path.basename(photo_path))
+                data.add_field("chat_id", str(self.chat_id))
+                with open(photo_path, "rb") as f:
+                    data.add_field("photo", f.read(), filename=os.path.basename(photo_path))
                 data.add_field("caption", caption)
                 data.add_field("parse_mode", "HTML")
-                await session.post(f"https://api.telegram.org/bot{token}/sendPhoto", data=data)
-        except Exception as e:
-            print(f"[TG] 图片发送失败: {e}")
+            try:
+                async with self._session.post(url, json=json, data=data) as resp:
+                    try:
+                        body = await resp.json(content_type=None)
+                    except ValueError:
+                        body = {}
+                    if resp.status == 429:
+                        delay = body.get("parameters", {}).get("retry_after", delay)
+                        print(f"[TG] {method} 被限流，{delay}s 后重试")
+                    elif resp.status >= 500:
+                        print(f"[TG] {method} 服务端错误 {resp.status}")
+                    else:
+                        if not body.get("ok") and "not modified" not in str(body.get("description", "")):
+                            print(f"[TG] {method} 失败: {body.get('description', resp.status)}")
+                        return body
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"[TG] {method} 网络错误: {e}")
+            if attempt < self.MAX_RETRIES - 1:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        return None
+
+    def _enqueue(self, kind, payload):
+        if not self.enabled:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._outbox.put_nowait, (kind, payload))
+        except RuntimeError:
+            # 发送线程已退出，事件循环已关闭
+            self.enabled = False
+
+    def send(self, message):
+        self._enqueue("message", message)
 
+    def send_photo(self, photo_path, caption=""):
+        if os.path.exists(photo_path):
+            self._enqueue("photo", (photo_path, caption))
+        else:
+            self.send(caption)
 
-def sync_tg_notify(message):
-    asyncio.run(tg_notify(message))
+    def start_status(self, text):
+        """发送一条进度消息，后续 update_status 原地编辑它"""
+        self._enqueue("status", text)
 
+    def update_status(self, text):
+        """只保留最新一次编辑，排队中的旧编辑会被跳过"""
+        self._edit_seq += 1
+        self._enqueue("edit", (self._edit_seq, text))
 
-def sync_tg_notify_photo(photo_path, caption=""):
-    asyncio.run(tg_notify_photo(photo_path, caption))
+    def close(self):
+        if not self.enabled or self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._outbox.put_nowait, None)
+        self._thread.join(timeout=120)
+        self._thread = None
 
 
 def encrypt_secret(public_key, secret_value):
@@ -237,59 +1150,725 @@ def encrypt_secret(public_key, secret_value):
     return base64.b64encode(encrypted).decode("utf-8")
 
 
-async def update_github_secret(secret_name, secret_value):
-    repo_token = os.environ.get("REPO_TOKEN", "").strip()
-    repository = os.environ.get("GITHUB_REPOSITORY", "").strip()
-    if not repo_token or not repository or not NACL_AVAILABLE:
-        return False
-    headers = {
+_PUBLIC_KEY_CACHE = {}
+
+
+def github_headers(repo_token):
+    return {
         "Accept": "application/vnd.github+json",
         "Authorization": f"Bearer {repo_token}",
         "X-GitHub-Api-Version": "2022-11-28",
     }
-    async with aiohttp.ClientSession() as session:
+
+
+async def get_repo_public_key(session, repository, headers):
+    """仓库 Actions 公钥在一次运行内只获取一次"""
+    if repository not in _PUBLIC_KEY_CACHE:
+        pk_url = f"https://api.github.com/repos/{repository}/actions/secrets/public-key"
+        async with session.get(pk_url, headers=headers) as resp:
+            if resp.status != 200:
+                return None
+            _PUBLIC_KEY_CACHE[repository] = await resp.json()
+    return _PUBLIC_KEY_CACHE[repository]
+
+
+async def update_github_secrets(secrets):
+    """批量更新 secrets：一个会话、一次公钥、每个值加密一次、并发 PUT。返回 {name: bool}"""
+    outcome = {name: False for name in secrets}
+    repo_token = os.environ.get("REPO_TOKEN", "").strip()
+    repository = os.environ.get("GITHUB_REPOSITORY", "").strip()
+    if not secrets or not repo_token or not repository or not NACL_AVAILABLE:
+        return outcome
+    headers = github_headers(repo_token)
+
+    async with aiohttp.ClientSession(headers=headers) as session:
         try:
-            pk_url = f"https://api.github.com/repos/{repository}/actions/secrets/public-key"
-            async with session.get(pk_url, headers=headers) as resp:
-                if resp.status != 200:
-                    return False
-                pk_data = await resp.json()
-            encrypted_value = encrypt_secret(pk_data["key"], secret_value)
-            secret_url = f"https://api.github.com/repos/{repository}/actions/secrets/{secret_name}"
-            async with session.put(secret_url, headers=headers, json={
-                "encrypted_value": encrypted_value, "key_id": pk_data["key_id"]
-            }) as resp:
-                return resp.status in (201, 204)
-        except:
-            return False
+            pk_data = await get_repo_public_key(session, repository, headers)
+        except Exception:
+            pk_data = None
+        if not pk_data:
+            return outcome
+
+        async def put_secret(name, value):
+            secret_url = f"https://api.github.com/repos/{repository}/actions/secrets/{name}"
+            try:
+                async with session.put(secret_url, json={
+                    "encrypted_value": encrypt_secret(pk_data["key"], value), "key_id": pk_data["key_id"]
+                }) as resp:
+                    outcome[name] = resp.status in (201, 204)
+            except Exception:
+                outcome[name] = False
+
+        await asyncio.gather(*(put_secret(name, value) for name, value in secrets.items()))
+    return outcome
+
+
+async def update_github_secret(secret_name, secret_value):
+    return (await update_github_secrets({secret_name: secret_value}))[secret_name]
+
+
+def commit_cookie_rotations(results, defer_vault=False):
+    """运行结束时统一提交本次收集到的 Cookie 轮换，并把结果写回各账号。
+    defer_vault: 分片模式下账号库的轮换留给 --merge-report 统一写回，避免各分片互相覆盖"""
+    pending = {}
+    vault = get_vault()
+    vault_results = []
+    for r in results:
+        rotated = r.pop("rotated_cookie", None)
+        if not rotated:
+            continue
+        if vault:
+            if vault.update_cookie(r.get("server_id", ""), rotated):
+                vault_results.append(r)
+        elif r.get("cookie_env"):
+            # 同一进程后续的重试和常驻模式的下一轮续期直接使用新 Cookie
+            os.environ[r["cookie_env"]] = rotated
+            pending[r["cookie_env"]] = rotated
+            r["cookie_rotation"] = "pending"
+
+    if vault_results and defer_vault:
+        for r in vault_results:
+            r["cookie_rotation"] = "pending"
+    elif vault_results:
+        with TRACER.span("commit_vault", accounts=len(vault_results)):
+            ok = vault.commit()
+        for r in vault_results:
+            r["cookie_updated"] = ok
+            r["cookie_rotation"] = "updated" if ok else "failed"
+        print(f"[账号库] {len(vault_results)} 个 Cookie 轮换已{'重新加密写回' if ok else '写回失败'}")
+    if not pending:
+        return {}
+    if not os.environ.get("REPO_TOKEN", "").strip() or not os.environ.get("GITHUB_REPOSITORY", "").strip():
+        print(f"[!] 未配置 REPO_TOKEN / GITHUB_REPOSITORY，{len(pending)} 个轮换后的 Cookie 只在当前进程内生效，"
+              f"请手动更新: {', '.join(sorted(pending))}")
+        for r in results:
+            if r.get("cookie_rotation") == "pending":
+                r["cookie_rotation"] = "local"
+        return {name: False for name in pending}
+
+    start = time.time()
+    with TRACER.span("update_github_secrets", secrets=len(pending)):
+        outcome = asyncio.run(update_github_secrets(pending))
+    for r in results:
+        if r.get("cookie_rotation") == "pending":
+            ok = outcome.get(r["cookie_env"], False)
+            r["cookie_updated"] = ok
+            r["cookie_rotation"] = "updated" if ok else "failed"
+    ok_count = sum(1 for ok in outcome.values() if ok)
+    print(f"[GitHub] Cookie 轮换提交 {ok_count}/{len(outcome)} 成功 ({time.time() - start:.1f}s)")
+    return outcome
+
+
+def extract_expiry_from_text(text, strict=False):
+    match = EXPIRY_LABEL_RE.search(text)
+    if match:
+        return match.group(1).strip()
+    if not strict:
+        match = EXPIRY_ANY_RE.search(text)
+        if match:
+            return match.group(1).strip()
+    return "Unknown"
 
 
 def get_expiry_from_page(sb):
+    return get_page_state(sb)["expiry"]
+
+
+def normalize_expiry_value(value):
+    """把 API 返回的时间 (ISO 或 'Y-m-d H:M:S') 转成页面上的本地时间格式"""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    value = value.strip()
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def find_expiry_in_json(data):
+    """在客户端 API 的 JSON 中查找到期时间字段 (expire/expiry/유통기한)"""
+    if isinstance(data, dict):
+        for key, value in data.items():
+            lowered = str(key).lower()
+            if "expir" in lowered or "유통기한" in lowered:
+                expiry = normalize_expiry_value(value)
+                if expiry:
+                    return expiry
+        for value in data.values():
+            expiry = find_expiry_in_json(value)
+            if expiry:
+                return expiry
+    elif isinstance(data, list):
+        for value in data:
+            expiry = find_expiry_in_json(value)
+            if expiry:
+                return expiry
+    return None
+
+
+async def probe_account_expiry(connector, account):
+    """不启动浏览器，用 remember_web Cookie 直接请求面板获取到期时间"""
+    probe = {"expiry": "Unknown", "source": None, "new_cookie": None}
+    server_id = account.get("id", "").strip()
+    cookie_name, cookie_value = parse_weirdhost_cookie(get_account_cookie(account))
+    if not server_id or not cookie_name or not cookie_value or server_id.startswith("http"):
+        return probe
+
+    jar = aiohttp.CookieJar(unsafe=True)
+    jar.update_cookies({cookie_name: cookie_value}, response_url=URL(f"{ORIGIN}/"))
+    timeout = aiohttp.ClientTimeout(total=HTTP_PROBE_TIMEOUT)
+    headers = {"User-Agent": HTTP_USER_AGENT, "Accept-Language": "ko-KR,ko;q=0.9"}
+
+    async with aiohttp.ClientSession(connector=connector, connector_owner=False, cookie_jar=jar,
+                                     timeout=timeout, headers=headers) as session:
+        try:
+            api_url = f"{ORIGIN}/api/client/servers/{server_id}"
+            async with session.get(api_url, headers={
+                "Accept": "application/json", "X-Requested-With": "XMLHttpRequest"
+            }, allow_redirects=False) as resp:
+                if resp.status == 200 and "json" in resp.content_type:
+                    expiry = find_expiry_in_json(await resp.json())
+                    if expiry:
+                        probe.update(expiry=expiry, source="api")
+
+            if probe["source"] is None:
+                async with session.get(build_server_url(server_id)) as resp:
+                    if resp.status == 200 and "/login" not in resp.url.path:
+                        expiry = extract_expiry_from_text(await resp.text(), strict=True)
+                        if expiry != "Unknown":
+                            probe.update(expiry=expiry, source="html")
+        except Exception as e:
+            print(f"[HTTP] {mask_server_id(server_id)} 探测失败: {str(e)[:80]}")
+
+        for cookie in jar:
+            if cookie.key.startswith("remember_web") and cookie.value and cookie.value != cookie_value:
+                probe["new_cookie"] = f"{cookie.key}={cookie.value}"
+                break
+    return probe
+
+
+async def probe_all_expiry(accounts):
+    connector = aiohttp.TCPConnector(limit=HTTP_PROBE_CONCURRENCY)
     try:
-        page_text = sb.get_page_source()
-        match = re.search(r'유통기한\s*(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})', page_text)
+        return await asyncio.gather(*(probe_account_expiry(connector, acc) for acc in accounts))
+    finally:
+        await connector.close()
+
+
+def http_precheck(indexed_accounts):
+    """HTTP 预检：返回 (无需续期的结果 {index: result}, 仍需浏览器处理的账号)"""
+    start = time.time()
+    with TRACER.span("http_precheck", accounts=len(indexed_accounts)):
+        probes = asyncio.run(probe_all_expiry([acc for _, acc in indexed_accounts]))
+
+    skipped = {}
+    remaining = []
+    for (i, account), probe in zip(indexed_accounts, probes):
+        expiry = probe["expiry"]
+        if probe["source"] and not should_renew(expiry):
+            result = new_result(account, i)
+            result.update({
+                "status": "skipped",
+                "skipped": True,
+                "original_expiry": expiry,
+                "new_expiry": expiry,
+                "message": "无需续期",
+                "rotated_cookie": probe["new_cookie"],
+            })
+            skipped[i] = result
+        else:
+            if probe["new_cookie"]:
+                # 浏览器改用轮换后的 Cookie 登录，并随结果提交（同一账号字典，重试时也生效）
+                account["probe_cookie"] = probe["new_cookie"]
+            remaining.append((i, account))
+
+    print(f"[HTTP] 预检完成 ({time.time() - start:.1f}s): "
+          f"{len(skipped)} 个无需续期, {len(remaining)} 个需启动浏览器")
+    return skipped, remaining
+
+
+PAGE_READY_JS = "return document.readyState === 'complete';"
+
+SERVER_PAGE_READY_JS = """
+if (document.readyState !== 'complete') return false;
+var path = location.pathname || '';
+if (path.indexOf('/login') !== -1 || path.indexOf('/auth') !== -1) return true;
+var text = (document.body && document.body.innerText) || '';
+return text.indexOf('유통기한') !== -1 && /\\d{4}-\\d{2}-\\d{2}\\s+\\d{2}:\\d{2}:\\d{2}/.test(text);
+"""
+
+POPUP_READY_JS = """
+if (document.querySelector('input[name="cf-turnstile-response"]')) return true;
+var text = (document.body && document.body.innerText) || '';
+return text.indexOf('Success') !== -1 || text.indexOf('아직') !== -1 || text.indexOf('NEXT') !== -1;
+"""
+
+POPUP_CLOSED_JS = "return document.querySelector('input[name=\"cf-turnstile-response\"]') === null;"
+
+
+def wait_for_condition(sb, condition_js, label, timeout=PAGE_WAIT_TIMEOUT, replaces=0, waits=None):
+    """轮询页面条件，满足即返回；超时兜底。replaces 为原先的固定等待秒数，用于统计节省的空等时间"""
+    start = time.time()
+    met = False
+    while True:
+        try:
+            if sb.execute_script(condition_js):
+                met = True
+                break
+        except Exception:
+            pass
+        if time.time() - start >= timeout:
+            break
+        time.sleep(PAGE_WAIT_POLL)
+    waited = time.time() - start
+    flag = "" if met else " (超时)"
+    print(f"[等待] {label}: {waited:.2f}s{flag}, 原固定等待 {replaces}s")
+    if waits is not None:
+        waits.append({"step": label, "waited": round(waited, 2), "met": met, "replaces": replaces})
+    return met
+
+
+def summarize_waits(waits):
+    waited = sum(w["waited"] for w in waits)
+    replaced = sum(w["replaces"] for w in waits)
+    return waited, replaced
+
+
+# 判定在页面内基于完整文本完成，每次只返回紧凑的状态；设置 SNAPSHOT_FILE 时才额外附带原始快照，
+# 供 classify_page / classify_popup（与页面内判定逻辑一致的 Python 版本）离线回放
+SNAPSHOT_JS = """
+function __whSnapshot() {
+    var input = document.querySelector('input[name="cf-turnstile-response"]');
+    var nodes = document.querySelectorAll('button');
+    var buttons = [];
+    for (var i = 0; i < nodes.length; i++) {
+        var rect = nodes[i].getBoundingClientRect();
+        buttons.push({text: (nodes[i].innerText || '').trim().slice(0, 80),
+                      x: Math.round(rect.x), width: Math.round(rect.width)});
+    }
+    // 与到期时间判定相同的范围：标签所在元素及其最近几层祖先中，标签之后的 200 个字符
+    var scopes = [];
+    var walker = document.createTreeWalker(document.body || document.documentElement, NodeFilter.SHOW_TEXT, {
+        acceptNode: function(n) {
+            return n.nodeValue.indexOf('유통기한') !== -1 ? NodeFilter.FILTER_ACCEPT : NodeFilter.FILTER_SKIP;
+        }
+    });
+    var node;
+    while ((node = walker.nextNode()) && scopes.length < 40) {
+        var el = node.parentElement;
+        for (var depth = 0; el && depth < 4; depth++, el = el.parentElement) {
+            var text = el.innerText || el.textContent || '';
+            var idx = text.indexOf('유통기한');
+            if (idx !== -1) scopes.push(text.slice(idx, idx + 200));
+        }
+    }
+    var heading = document.querySelector('h1');
+    return {
+        url: location.href,
+        title: document.title || '',
+        heading: heading ? heading.innerText.trim() : '',
+        text: (document.body && document.body.innerText) || '',
+        buttons: buttons,
+        expiry_scopes: scopes,
+        turnstile: input ? {value_length: (input.value || '').length} : null
+    };
+}
+"""
+
+SNAPSHOT_ENABLED_JS = "true" if SNAPSHOT_FILE else "false"
+
+PAGE_STATE_JS = """
+var re = /\\d{4}-\\d{2}-\\d{2}\\s+\\d{2}:\\d{2}:\\d{2}/;
+var path = location.pathname || '';
+var state = {
+    url: location.href,
+    login_page: path.indexOf('/login') !== -1 || path.indexOf('/auth') !== -1,
+    expiry: null,
+    has_renew_button: false,
+    server_name: null
+};
+var root = document.body || document.documentElement;
+var walker = document.createTreeWalker(root, NodeFilter.SHOW_TEXT, {
+    acceptNode: function(n) {
+        return n.nodeValue.indexOf('유통기한') !== -1 ? NodeFilter.FILTER_ACCEPT : NodeFilter.FILTER_SKIP;
+    }
+});
+var node;
+while (!state.expiry && (node = walker.nextNode())) {
+    // 只在标签所在元素及其最近的几层祖先中，取标签之后的第一个时间
+    var el = node.parentElement;
+    for (var depth = 0; el && depth < 4 && !state.expiry; depth++, el = el.parentElement) {
+        var text = el.innerText || el.textContent || '';
+        var idx = text.indexOf('유통기한');
+        var m = idx === -1 ? null : text.slice(idx, idx + 200).match(re);
+        if (m) state.expiry = m[0].replace(/\\s+/, ' ');
+    }
+}
+var buttons = document.querySelectorAll('button');
+for (var i = 0; i < buttons.length; i++) {
+    if ((buttons[i].innerText || '').indexOf('시간추가') !== -1 && buttons[i].getBoundingClientRect().width > 0) {
+        state.has_renew_button = true;
+        break;
+    }
+}
+var heading = document.querySelector('h1');
+state.server_name = (heading && heading.innerText.trim()) || document.title || null;
+// 本页资源统计：加载了资源策略扩展时由扩展按标签页统计（含跨域请求和被拦截的请求），
+// 否则退回 Resource Timing（跨域资源的 transferSize 通常为 0）
+var res = null;
+try { res = JSON.parse(document.documentElement.getAttribute('data-wh-resources')); } catch (e) {}
+if (!res) {
+    var nav = performance.getEntriesByType('navigation')[0];
+    var entries = performance.getEntriesByType('resource');
+    res = {requests: entries.length + 1, bytes: nav ? nav.transferSize || 0 : 0};
+    for (var j = 0; j < entries.length; j++) res.bytes += entries[j].transferSize || 0;
+}
+res.page = String(performance.timeOrigin);
+state.resources = res;
+if (__SNAPSHOT__) state.snapshot = __whSnapshot();
+return state;
+""".replace("__SNAPSHOT__", SNAPSHOT_ENABLED_JS) + SNAPSHOT_JS
+
+PAGE_FIELDS = ("url", "login_page", "expiry", "has_renew_button", "server_name", "logged_in")
+
+
+def find_labelled_expiry(snapshot):
+    """与页面内判定相同：在标签所在元素及其祖先的文本中，取 '유통기한' 之后 200 个字符内的第一个时间。
+    旧快照没有 expiry_scopes 时退回在整页文本中查找"""
+    for scope in snapshot.get("expiry_scopes") or []:
+        match = EXPIRY_ANY_RE.search(scope[:200])
         if match:
-            return match.group(1).strip()
-        match = re.search(r'(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})', page_text)
+            return re.sub(r"\s+", " ", match.group(1), count=1)
+    if snapshot.get("expiry_scopes") is not None:
+        return None
+    text = snapshot.get("text") or ""
+    start = 0
+    while True:
+        idx = text.find("유통기한", start)
+        if idx == -1:
+            return None
+        match = EXPIRY_ANY_RE.search(text[idx:idx + 200])
         if match:
-            return match.group(1).strip()
-        return "Unknown"
-    except:
-        return "Unknown"
+            return re.sub(r"\s+", " ", match.group(1), count=1)
+        start = idx + 1
+
+
+def classify_page(snapshot):
+    """服务器页快照 -> 登录状态、到期时间、续期按钮、服务器名（PAGE_STATE_JS 的 Python 版本，用于离线回放）"""
+    path = urlsplit(snapshot.get("url") or "").path
+    login_page = "/login" in path or "/auth" in path
+    expiry = find_labelled_expiry(snapshot) or "Unknown"
+    has_renew_button = any(
+        "시간추가" in b.get("text", "") and b.get("width", 0) > 0 for b in snapshot.get("buttons") or []
+    )
+    return {
+        "url": snapshot.get("url") or "",
+        "login_page": login_page,
+        "expiry": expiry,
+        "has_renew_button": has_renew_button,
+        "server_name": snapshot.get("heading") or snapshot.get("title") or None,
+        "logged_in": not login_page and (expiry != "Unknown" or has_renew_button),
+    }
+
+
+def classify_popup(snapshot):
+    """续期弹窗快照 -> Turnstile 是否存在/已通过、弹窗是否打开、结果 success/cooldown/None
+    （POPUP_OBSERVER_JS 中 classify 的 Python 版本，用于离线回放）"""
+    buttons = snapshot.get("buttons") or []
+    turnstile = snapshot.get("turnstile")
+    text = snapshot.get("text") or ""
+    has_next = any("NEXT" in b.get("text", "") or "Next" in b.get("text", "") for b in buttons)
+    popup_open = bool(turnstile) and any(
+        "시간추가" in b.get("text", "") and "DELETE" not in b.get("text", "")
+        and b.get("x", 0) > 200 and b.get("width", 0) > 0
+        for b in buttons
+    )
+    has_success_title = "Success" in text
+    has_success_content = "성공" in text or "갱신" in text or "연장" in text
+    has_cooldown = "아직" in text or "Error" in text
+    result = None
+    if has_next or has_success_title:
+        if "아직" in text:
+            result = "cooldown"
+        elif has_success_title and has_success_content:
+            result = "success"
+        elif has_next and has_cooldown:
+            result = "cooldown"
+        elif has_next and has_success_content:
+            result = "success"
+    return {
+        "turnstile": turnstile is not None,
+        "solved": bool(turnstile) and turnstile.get("value_length", 0) > 20,
+        "popup_open": popup_open,
+        "result": result,
+    }
+
+
+class SnapshotRecorder:
+    """把每次状态变化时的页面快照和判定结果追加到 JSONL，供 replay_snapshots.py 离线回放"""
+
+    def __init__(self, path):
+        self.path = path
+        self.account = None
+        self._last = {}
+        self._pending_label = None
+        self._last_popup = None
+
+    def begin(self, account_index):
+        self.account = account_index
+        self._last = {}
+        self._pending_label = None
+        self._last_popup = None
+
+    def record(self, kind, snapshot, predicted):
+        if not self.path or not snapshot:
+            return
+        key = json.dumps(snapshot, sort_keys=True, ensure_ascii=False)
+        if self._last.get(kind) == key:
+            return
+        self._last[kind] = key
+        entry = {
+            "kind": kind, "account": self.account,
+            "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "snapshot": snapshot, "predicted": predicted,
+        }
+        self._write(entry)
+        if kind == "popup":
+            self._last_popup = entry
+            if predicted.get("result"):
+                self._pending_label = entry
+
+    def label_outcome(self, expiry_increased):
+        """按续期前后的到期时间（与弹窗判定无关的真实结果）标注最后一个给出结果的弹窗快照；
+        没有任何快照给出结果时标注最后一个弹窗快照。expiry_increased 为 None 表示无法判断，不标注"""
+        entry = self._pending_label or self._last_popup
+        self._pending_label = None
+        self._last_popup = None
+        if entry and expiry_increased is not None:
+            self._write(dict(entry, label={"success": expiry_increased}, relabel=True))
+
+    def _write(self, entry):
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"[快照] 写入失败: {e}")
+            self.path = None
+
+
+SNAPSHOTS = SnapshotRecorder(SNAPSHOT_FILE)
+
+
+def get_page_state(sb, pages=None):
+    """一次脚本调用提取页面结构化状态：到期时间、登录状态、续期按钮、服务器名。
+    传入 pages 时按页面记录资源统计（同一页面多次读取只保留最新一次）"""
+    try:
+        state = sb.execute_script(PAGE_STATE_JS)
+    except Exception:
+        state = None
+    if not state:
+        state = {"url": "", "login_page": False, "expiry": None, "has_renew_button": False, "server_name": None}
+    if pages is not None and state.get("resources"):
+        pages[state["resources"]["page"]] = state["resources"]
+    state["expiry"] = state.get("expiry") or "Unknown"
+    state["logged_in"] = not state["login_page"] and (state["expiry"] != "Unknown" or state["has_renew_button"])
+    snapshot = state.pop("snapshot", None)
+    if snapshot:
+        SNAPSHOTS.record("page", snapshot, {k: state.get(k) for k in PAGE_FIELDS})
+    return state
 
 
 def is_logged_in(sb):
+    return get_page_state(sb)["logged_in"]
+
+
+RESOURCE_COUNTERS = ("requests", "bytes", "blocked", "blocked_bytes", "unknown")
+
+
+def summarize_resources(pages):
+    """合并各页面的资源统计；sizes 为 observe 模式下实际加载的、lean 会拦截的资源大小"""
+    summary = {"pages": len(pages), "sizes": {}}
+    for key in RESOURCE_COUNTERS:
+        summary[key] = 0
+    for res in pages.values():
+        for key in RESOURCE_COUNTERS:
+            summary[key] += res.get(key) or 0
+        summary["sizes"].update(res.get("sizes") or {})
+    return summary
+
+
+def load_resource_sizes():
     try:
-        url = sb.get_current_url()
-        if "/login" in url or "/auth" in url:
-            return False
-        if get_expiry_from_page(sb) != "Unknown":
-            return True
-        if sb.is_element_present("//button//span[contains(text(), '시간추가')]"):
-            return True
-        return False
-    except:
-        return False
+        with open(RESOURCE_SIZES_FILE, "r", encoding="utf-8") as f:
+            sizes = json.load(f)
+        return sizes if isinstance(sizes, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def record_resource_sizes(results):
+    """把 observe 模式学到的资源大小并入 STATE_DIR，只保留最近的 RESOURCE_SIZES_LIMIT 条"""
+    learned = {}
+    for r in unrecorded(results):
+        learned.update(r.pop("resource_sizes", None) or {})
+    if not learned:
+        return
+    sizes = load_resource_sizes()
+    for url, size in learned.items():
+        sizes.pop(url, None)
+        sizes[url] = size
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(RESOURCE_SIZES_FILE, "w", encoding="utf-8") as f:
+            json.dump(dict(list(sizes.items())[-RESOURCE_SIZES_LIMIT:]), f)
+    except OSError as e:
+        print(f"[资源] 大小记录保存失败: {e}")
+
+
+def resource_policy_rules(observe=False):
+    """生成 declarativeNetRequest 规则；拦截列表中的面板域名和始终放行的域名会被剔除。
+    observe 时同样的条件改为放行，只用于匹配统计"""
+    allow = list(RESOURCE_ALWAYS_ALLOW)
+    domains = [
+        d for d in RESOURCE_BLOCK_DOMAINS + RESOURCE_BLOCK_EXTRA
+        if d not in allow and DOMAIN != d and not DOMAIN.endswith("." + d)
+    ]
+    action = {"type": "allow" if observe else "block"}
+    guard = {"excludedRequestDomains": allow, "excludedInitiatorDomains": allow}
+    rules = [
+        {"id": 1, "priority": 2, "action": {"type": "allow"}, "condition": {"requestDomains": allow}},
+        {"id": 2, "priority": 1, "action": action,
+         "condition": dict(guard, resourceTypes=RESOURCE_BLOCK_TYPES)},
+    ]
+    if domains:
+        rules.append({"id": 3, "priority": 1, "action": action,
+                      "condition": dict(guard, requestDomains=domains)})
+    return rules
+
+
+# 扩展后台：按标签页统计请求数和字节数（Content-Length，跨域同样可见），
+# 通过规则匹配反馈（onRuleMatchedDebug，仅解包加载的扩展可用）统计命中拦截规则的请求。
+# 统计以增量发给页面内的内容脚本，页面换了就自然从零开始
+RESOURCE_BACKGROUND_JS = """
+var OBSERVE = __OBSERVE__;
+var SIZES = {};
+fetch(chrome.runtime.getURL('sizes.json')).then(function(r) { return r.json(); })
+    .then(function(s) { SIZES = s || {}; }).catch(function() {});
+var pending = {};
+var timers = {};
+var watching = {};
+
+function urlKey(url) {
+    try { var u = new URL(url); return u.origin + u.pathname; } catch (e) { return url; }
+}
+function delta(tabId) {
+    return pending[tabId] || (pending[tabId] = {requests: 0, bytes: 0, blocked: 0, blocked_bytes: 0, unknown: 0, sizes: {}});
+}
+function merge(target, d) {
+    ['requests', 'bytes', 'blocked', 'blocked_bytes', 'unknown'].forEach(function(k) { target[k] += d[k]; });
+    Object.assign(target.sizes, d.sizes);
+}
+function flush(tabId) {
+    if (timers[tabId]) return;
+    timers[tabId] = setTimeout(function() {
+        delete timers[tabId];
+        var d = pending[tabId];
+        delete pending[tabId];
+        if (!d) return;
+        // 内容脚本还没就绪时发送失败，增量留到下一次
+        chrome.tabs.sendMessage(tabId, d).catch(function() { merge(delta(tabId), d); flush(tabId); });
+    }, 200);
+}
+
+chrome.webRequest.onBeforeRequest.addListener(function(info) {
+    if (info.tabId < 0) return;
+    delta(info.tabId).requests++;
+    flush(info.tabId);
+}, {urls: ['<all_urls>']});
+
+chrome.webRequest.onCompleted.addListener(function(info) {
+    var watched = watching[info.requestId];
+    delete watching[info.requestId];
+    if (info.tabId < 0 || info.fromCache) return;
+    var size = 0;
+    (info.responseHeaders || []).forEach(function(h) {
+        if (h.name.toLowerCase() === 'content-length') size = parseInt(h.value, 10) || 0;
+    });
+    var d = delta(info.tabId);
+    d.bytes += size;
+    if (watched) {
+        if (size) { d.blocked_bytes += size; d.sizes[urlKey(info.url)] = size; } else { d.unknown++; }
+    }
+    flush(info.tabId);
+}, {urls: ['<all_urls>']}, ['responseHeaders']);
+
+chrome.webRequest.onErrorOccurred.addListener(function(info) {
+    delete watching[info.requestId];
+}, {urls: ['<all_urls>']});
+
+chrome.declarativeNetRequest.onRuleMatchedDebug.addListener(function(match) {
+    var req = match.request;
+    // 规则 1 是 Turnstile 的放行规则，不计入
+    if (req.tabId < 0 || match.rule.ruleId === 1) return;
+    var d = delta(req.tabId);
+    d.blocked++;
+    if (OBSERVE) {
+        watching[req.requestId] = true;
+    } else if (SIZES[urlKey(req.url)]) {
+        d.blocked_bytes += SIZES[urlKey(req.url)];
+    } else {
+        d.unknown++;
+    }
+    flush(req.tabId);
+});
+"""
+
+RESOURCE_CONTENT_JS = """
+var total = {requests: 0, bytes: 0, blocked: 0, blocked_bytes: 0, unknown: 0, sizes: {}};
+chrome.runtime.onMessage.addListener(function(d) {
+    ['requests', 'bytes', 'blocked', 'blocked_bytes', 'unknown'].forEach(function(k) { total[k] += d[k]; });
+    Object.assign(total.sizes, d.sizes);
+    if (document.documentElement) document.documentElement.setAttribute('data-wh-resources', JSON.stringify(total));
+});
+"""
+
+
+@functools.lru_cache(maxsize=1)
+def resource_policy_extension():
+    """把资源策略写成一个临时扩展目录供 Chrome 加载；RESOURCE_POLICY=off 时返回 None。
+    uc_open_with_reconnect 每次都在新标签页打开并重连 chromedriver，
+    CDP 的 Network.setBlockedURLs 会随 DevTools 会话一起失效，扩展规则则对整个浏览器持续生效"""
+    if RESOURCE_POLICY not in ("lean", "observe"):
+        return None
+    observe = RESOURCE_POLICY == "observe"
+    ext_dir = tempfile.mkdtemp(prefix="weirdhost_policy_")
+    atexit.register(shutil.rmtree, ext_dir, True)
+    manifest = {
+        "manifest_version": 3,
+        "name": "weirdhost resource policy",
+        "version": "1.0",
+        "permissions": ["declarativeNetRequest", "declarativeNetRequestFeedback", "webRequest"],
+        "host_permissions": ["<all_urls>"],
+        "background": {"service_worker": "background.js"},
+        "content_scripts": [{"matches": ["<all_urls>"], "js": ["content.js"], "run_at": "document_start"}],
+        "declarative_net_request": {
+            "rule_resources": [{"id": "policy", "enabled": True, "path": "rules.json"}]
+        },
+    }
+    files = {
+        "manifest.json": json.dumps(manifest),
+        "rules.json": json.dumps(resource_policy_rules(observe)),
+        "sizes.json": json.dumps({} if observe else load_resource_sizes()),
+        "background.js": RESOURCE_BACKGROUND_JS.replace("__OBSERVE__", "true" if observe else "false"),
+        "content.js": RESOURCE_CONTENT_JS,
+    }
+    for name, content in files.items():
+        with open(os.path.join(ext_dir, name), "w", encoding="utf-8") as f:
+            f.write(content)
+    return ext_dir
 
 
 EXPAND_POPUP_JS = """
@@ -332,33 +1911,155 @@ EXPAND_POPUP_JS = """
 """
 
 
-def check_turnstile_exists(sb):
-    try:
-        return sb.execute_script("""
-            return document.querySelector('input[name="cf-turnstile-response"]') !== null;
-        """)
-    except:
-        return False
+POPUP_OBSERVER_JS = """
+(function() {
+    var w = window.__whPopup;
+    if (w && w.installed) return w.state;
+""" + SNAPSHOT_JS + """
+    function classify() {
+        var input = document.querySelector('input[name="cf-turnstile-response"]');
+        var buttons = document.querySelectorAll('button');
+        var hasNextBtn = false;
+        var popupOpen = false;
+        for (var i = 0; i < buttons.length; i++) {
+            var text = buttons[i].innerText || '';
+            if (text.includes('NEXT') || text.includes('Next')) hasNextBtn = true;
+            if (input && !popupOpen && text.includes('시간추가') && !text.includes('DELETE')) {
+                var rect = buttons[i].getBoundingClientRect();
+                if (rect.x > 200 && rect.width > 0) popupOpen = true;
+            }
+        }
+        var bodyText = (document.body && document.body.innerText) || '';
+        var hasSuccessTitle = bodyText.includes('Success');
+        var hasSuccessContent = bodyText.includes('성공') || bodyText.includes('갱신') || bodyText.includes('연장');
+        var hasCooldown = bodyText.includes('아직') || bodyText.includes('Error');
+        var result = null;
+        if (hasNextBtn || hasSuccessTitle) {
+            if (hasCooldown && bodyText.includes('아직')) result = 'cooldown';
+            else if (hasSuccessTitle && hasSuccessContent) result = 'success';
+            else if (hasNextBtn && hasCooldown) result = 'cooldown';
+            else if (hasNextBtn && hasSuccessContent) result = 'success';
+        }
+        return {
+            turnstile: input !== null,
+            solved: !!(input && input.value && input.value.length > 20),
+            popup_open: popupOpen,
+            result: result
+        };
+    }
 
+    w = window.__whPopup = {installed: true, waiters: [], state: null};
 
-def check_turnstile_solved(sb):
+    function refresh() {
+        var next = classify();
+        var prev = w.state;
+        if (prev && prev.turnstile === next.turnstile && prev.solved === next.solved &&
+                prev.popup_open === next.popup_open && prev.result === next.result) {
+            return;
+        }
+        next.version = prev ? prev.version + 1 : 1;
+        next.changed_at = Date.now();
+        // 只在记录快照时附带原始快照，且只在判定变化时生成一次
+        if (__SNAPSHOT__) next.snapshot = __whSnapshot();
+        w.state = next;
+        var waiters = w.waiters;
+        w.waiters = [];
+        waiters.forEach(function(cb) { cb(next); });
+    }
+
+    var scheduled = false;
+    new MutationObserver(function() {
+        if (scheduled) return;
+        scheduled = true;
+        setTimeout(function() { scheduled = false; refresh(); }, 0);
+    }).observe(document.documentElement, {
+        subtree: true, childList: true, characterData: true, attributes: true
+    });
+    // Turnstile 通过 .value 写入 token，不会触发 DOM 变更，额外做页面内轮询
+    setInterval(refresh, 100);
+    refresh();
+    return w.state;
+})();
+""".replace("__SNAPSHOT__", SNAPSHOT_ENABLED_JS)
+
+WAIT_POPUP_STATE_JS = """
+var done = arguments[arguments.length - 1];
+var since = arguments[0];
+var w = window.__whPopup;
+if (!w || !w.state) { done(null); return; }
+if (w.state.version !== since) { done(w.state); return; }
+var timer = setTimeout(function() { done(w.state); }, arguments[1]);
+w.waiters.push(function(state) { clearTimeout(timer); done(state); });
+"""
+
+EMPTY_POPUP_STATE = {"turnstile": False, "solved": False, "popup_open": False, "result": None, "version": 0}
+
+
+def popup_state(raw):
+    """页面内观察器返回的紧凑状态；附带快照时交给 SNAPSHOTS 记录后去掉"""
+    if not raw:
+        return dict(EMPTY_POPUP_STATE)
+    snapshot = raw.pop("snapshot", None)
+    if snapshot:
+        SNAPSHOTS.record("popup", snapshot, {k: raw.get(k) for k in ("turnstile", "solved", "popup_open", "result")})
+    return raw
+
+
+def read_popup_state(sb):
+    """一次往返读取弹窗状态（首次调用时注入页面内观察器）"""
     try:
-        return sb.execute_script("""
-            var input = document.querySelector('input[name="cf-turnstile-response"]');
-            return input && input.value && input.value.length > 20;
-        """)
-    except:
-        return False
+        return popup_state(sb.execute_script("return " + POPUP_OBSERVER_JS.strip()))
+    except Exception:
+        return dict(EMPTY_POPUP_STATE)
 
 
-def get_turnstile_checkbox_coords(sb):
+def wait_popup_state(sb, since_version, timeout):
+    """阻塞直到页面内状态版本号变化或超时，返回最新状态"""
+    previous = None
     try:
-        coords = sb.execute_script("""
-            var iframes = document.querySelectorAll('iframe');
-            for (var i = 0; i < iframes.length; i++) {
-                var src = iframes[i].src || '';
-                if (src.includes('cloudflare') || src.includes('turnstile')) {
-                    var rect = iframes[i].getBoundingClientRect();
+        previous = sb.driver.timeouts.script
+        sb.driver.set_script_timeout(timeout + 5)
+        state = sb.driver.execute_async_script(WAIT_POPUP_STATE_JS, since_version, int(timeout * 1000))
+        if state:
+            return popup_state(state)
+    except Exception:
+        pass
+    finally:
+        # 异步脚本超时是整个会话的设置，用完恢复原值
+        if previous is not None:
+            try:
+                sb.driver.set_script_timeout(previous)
+            except Exception:
+                pass
+    return read_popup_state(sb)
+
+
+def wait_popup_until(sb, state, predicate, timeout):
+    deadline = time.time() + timeout
+    while not predicate(state):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        state = wait_popup_state(sb, state.get("version", 0), remaining)
+    return state
+
+
+def check_turnstile_exists(sb):
+    return read_popup_state(sb)["turnstile"]
+
+
+def check_turnstile_solved(sb):
+    return read_popup_state(sb)["solved"]
+
+
+def get_turnstile_checkbox_coords(sb):
+    try:
+        coords = sb.execute_script("""
+            var iframes = document.querySelectorAll('iframe');
+            for (var i = 0; i < iframes.length; i++) {
+                var src = iframes[i].src || '';
+                if (src.includes('cloudflare') || src.includes('turnstile')) {
+                    var rect = iframes[i].getBoundingClientRect();
                     if (rect.width > 0 && rect.height > 0) {
                         return {
                             x: rect.x,
@@ -385,6 +2086,11 @@ def activate_browser_window():
             capture_output=True, text=True, timeout=3
         )
         window_ids = result.stdout.strip().split('\n')
+        if len(window_ids) > 1:
+            # 多个 Chrome 窗口（浏览器上下文）时，已在前台的窗口就是当前账号的窗口
+            active = subprocess.run(["xdotool", "getactivewindow"], capture_output=True, text=True, timeout=2)
+            if active.stdout.strip() in window_ids:
+                return True
         if window_ids and window_ids[0]:
             subprocess.run(
                 ["xdotool", "windowactivate", window_ids[0]],
@@ -414,15 +2120,152 @@ def xdotool_click(x, y):
         return False
 
 
-def click_turnstile_checkbox(sb):
-    coords = get_turnstile_checkbox_coords(sb)
-    if not coords:
-        print("[!] 无法获取 Turnstile 坐标")
-        return False
+class XdotoolInput:
+    name = "xdotool"
 
-    print(f"[*] Turnstile 位置: ({coords['x']:.0f}, {coords['y']:.0f})")
+    def click(self, x, y, driver=None):
+        return xdotool_click(x, y)
 
-    try:
+
+class XTestInput:
+    """保持一个 X 连接，通过 XTest 扩展直接注入鼠标事件；Chrome 窗口按浏览器缓存，每次点击前检查是否仍然有效"""
+    name = "xtest"
+
+    def __init__(self):
+        self.display = xdisplay.Display()
+        if not self.display.has_extension("XTEST"):
+            self.display.close()
+            raise RuntimeError("X server 不支持 XTEST 扩展")
+        self.root = self.display.screen().root
+        self.windows = weakref.WeakKeyDictionary()
+
+    def _chrome_windows(self, parent=None, depth=0):
+        parent = parent or self.root
+        for child in parent.query_tree().children:
+            try:
+                wm_class = child.get_wm_class() or ()
+                viewable = child.get_attributes().map_state == X.IsViewable
+            except Exception:
+                continue
+            if viewable and any("chrom" in c.lower() for c in wm_class):
+                yield child
+            elif depth < 2:
+                yield from self._chrome_windows(child, depth + 1)
+
+    def _find_chrome_window(self, title=""):
+        """优先选标题包含当前页面标题的 Chrome 窗口（多个浏览器/上下文窗口时），否则取第一个"""
+        first = None
+        for window in self._chrome_windows():
+            if title:
+                try:
+                    if title in (window.get_wm_name() or ""):
+                        return window
+                except Exception:
+                    pass
+            first = first or window
+        return first
+
+    def _valid(self, window):
+        try:
+            return window.get_attributes().map_state == X.IsViewable
+        except Exception:
+            return False
+
+    def _activate(self, driver=None):
+        window = self.windows.get(driver) if driver is not None else None
+        if window is not None and self._valid(window):
+            return True
+        title = ""
+        if driver is not None:
+            try:
+                title = driver.title
+            except Exception:
+                pass
+        window = self._find_chrome_window(title)
+        if window is None:
+            return False
+        window.configure(stack_mode=X.Above)
+        window.set_input_focus(X.RevertToParent, X.CurrentTime)
+        if driver is not None:
+            self.windows[driver] = window
+        return True
+
+    def forget(self, driver):
+        self.windows.pop(driver, None)
+
+    def click(self, x, y, driver=None):
+        try:
+            if not self._activate(driver):
+                # 没有找到或无法聚焦 Chrome 窗口时不点击，否则会点到指针下的其他窗口
+                print("[!] XTest 未找到 Chrome 窗口，跳过点击")
+                return False
+            xtest.fake_input(self.display, X.MotionNotify, x=int(x), y=int(y))
+            xtest.fake_input(self.display, X.ButtonPress, 1)
+            xtest.fake_input(self.display, X.ButtonRelease, 1)
+            self.display.sync()
+            return True
+        except Exception as e:
+            print(f"[!] XTest 点击失败: {e}")
+            if driver is not None:
+                self.forget(driver)
+            return False
+
+
+class CdpInput:
+    """通过 CDP Input.dispatchMouseEvent 在页面内派发鼠标事件，坐标为视口坐标，不需要显示服务器"""
+    name = "cdp"
+
+    def click(self, x, y, driver):
+        x, y = int(x), int(y)
+        try:
+            # 从附近分几步移入再按下，页面和 iframe 收到与真实点击相同的事件序列
+            start_x, start_y = x - random.randint(40, 120), y + random.randint(-20, 20)
+            for step in (1, 2, 3):
+                driver.execute_cdp_cmd("Input.dispatchMouseEvent", {
+                    "type": "mouseMoved",
+                    "x": start_x + (x - start_x) * step / 3,
+                    "y": start_y + (y - start_y) * step / 3,
+                })
+                time.sleep(random.uniform(0.02, 0.06))
+            for event_type in ("mousePressed", "mouseReleased"):
+                driver.execute_cdp_cmd("Input.dispatchMouseEvent", {
+                    "type": event_type, "x": x, "y": y, "button": "left", "clickCount": 1,
+                })
+                time.sleep(random.uniform(0.05, 0.12))
+            return True
+        except Exception as e:
+            print(f"[!] CDP 点击失败: {e}")
+            return False
+
+
+_INPUT_BACKENDS = {}
+
+
+def get_input_backend():
+    """按 DISPLAY 缓存输入后端：cdp 不依赖显示；否则优先 XTest，不可用时回退 xdotool"""
+    key = "cdp" if INPUT_BACKEND == "cdp" else os.environ.get("DISPLAY", "")
+    if key not in _INPUT_BACKENDS:
+        backend = None
+        if key == "cdp":
+            backend = CdpInput()
+        elif INPUT_BACKEND in ("auto", "xtest") and XLIB_AVAILABLE:
+            try:
+                backend = XTestInput()
+            except Exception as e:
+                print(f"[!] XTest 后端不可用，回退 xdotool: {e}")
+        _INPUT_BACKENDS[key] = backend or XdotoolInput()
+        print(f"[*] 输入后端: {_INPUT_BACKENDS[key].name}")
+    return _INPUT_BACKENDS[key]
+
+
+_WINDOW_OFFSETS = weakref.WeakKeyDictionary()
+_ACTIVE_CONTEXTS = weakref.WeakKeyDictionary()
+
+
+def get_window_offset(sb):
+    """页面坐标到屏幕坐标的偏移（窗口位置 + 浏览器工具栏高度），每个浏览器只计算一次"""
+    driver = sb.driver
+    if driver not in _WINDOW_OFFSETS:
         window_info = sb.execute_script("""
             return {
                 screenX: window.screenX || 0,
@@ -432,70 +2275,127 @@ def click_turnstile_checkbox(sb):
             };
         """)
         chrome_bar_height = window_info["outerHeight"] - window_info["innerHeight"]
-        abs_x = coords["click_x"] + window_info["screenX"]
-        abs_y = coords["click_y"] + window_info["screenY"] + chrome_bar_height
-        return xdotool_click(abs_x, abs_y)
+        _WINDOW_OFFSETS[driver] = (window_info["screenX"], window_info["screenY"] + chrome_bar_height)
+    return _WINDOW_OFFSETS[driver]
+
+
+def click_turnstile_checkbox(sb, offset_x=30):
+    coords = get_turnstile_checkbox_coords(sb)
+    if not coords:
+        print("[!] 无法获取 Turnstile 坐标")
+        return False
+
+    print(f"[*] Turnstile 位置: ({coords['x']:.0f}, {coords['y']:.0f}), 点击偏移 {offset_x}")
+
+    try:
+        context = _ACTIVE_CONTEXTS.get(sb.driver)
+        if context:
+            context.bring_to_front()
+        backend = get_input_backend()
+        if backend.name == "cdp":
+            # CDP 使用 iframe 的视口坐标，不需要换算窗口位置
+            return backend.click(round(coords["x"] + offset_x), coords["click_y"], sb.driver)
+        offset_left, offset_top = get_window_offset(sb)
+        abs_x = round(coords["x"] + offset_x) + offset_left
+        abs_y = coords["click_y"] + offset_top
+        return backend.click(abs_x, abs_y, sb.driver)
     except Exception as e:
         print(f"[!] 坐标计算失败: {e}")
         return False
 
 
-def check_result_popup(sb):
+class TurnstileStats:
+    """Turnstile 求解历史：记录每次弹窗的点击次数、耗时和有效偏移，据此调整求解参数"""
+
+    def __init__(self, records=None):
+        self.records = records or []
+
+    @classmethod
+    def load(cls):
+        try:
+            with open(TURNSTILE_STATS_FILE, "r", encoding="utf-8") as f:
+                records = json.load(f).get("records", [])
+            return cls(records if isinstance(records, list) else [])
+        except (OSError, ValueError, AttributeError):
+            return cls()
+
+    def save(self):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = TURNSTILE_STATS_FILE + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"records": self.records[-TURNSTILE_HISTORY_LIMIT:]}, f, ensure_ascii=False)
+        os.replace(tmp_path, TURNSTILE_STATS_FILE)
+
+    def tuning(self):
+        params = {
+            "attempt_wait": 4.0,
+            "max_attempts": 6,
+            "pre_click_wait": 0.0,
+            "offsets": list(TURNSTILE_OFFSETS),
+        }
+        records = self.records[-TURNSTILE_HISTORY_LIMIT:]
+        if len(records) < TURNSTILE_MIN_SAMPLES:
+            return params
+
+        clicked = [r for r in records if r.get("solved") and r.get("attempts")]
+        solve_times = [r["solve_time"] for r in clicked if r.get("solve_time") is not None]
+        if solve_times:
+            params["attempt_wait"] = min(10.0, max(1.5, percentile(solve_times, 90) * 1.5))
+        if clicked:
+            needed = math.ceil(percentile([r["attempts"] for r in clicked], 95))
+            params["max_attempts"] = min(6, max(2, needed + 1))
+
+        auto = [r for r in records if r.get("auto_solved")]
+        if len(auto) * 2 >= len(records):
+            params["pre_click_wait"] = min(5.0, percentile([r["auto_wait"] for r in auto], 75))
+
+        tally = {}
+        for r in records:
+            for click in r.get("clicks", []):
+                hits = tally.setdefault(click["offset"], [0, 0])
+                hits[0] += 1 if click["solved"] else 0
+                hits[1] += 1
+        default_order = {o: n for n, o in enumerate(TURNSTILE_OFFSETS)}
+        params["offsets"] = sorted(
+            set(TURNSTILE_OFFSETS) | set(tally),
+            key=lambda o: (-(tally.get(o, [0, 0])[0] + 1) / (tally.get(o, [0, 0])[1] + 2),
+                           default_order.get(o, len(default_order)))
+        )
+        return params
+
+
+_TURNSTILE_TUNING = None
+
+
+def get_turnstile_tuning():
+    global _TURNSTILE_TUNING
+    if _TURNSTILE_TUNING is None:
+        stats = TurnstileStats.load()
+        _TURNSTILE_TUNING = stats.tuning()
+        t = _TURNSTILE_TUNING
+        print(f"[Turnstile] 历史 {len(stats.records)} 条: 每次等待 {t['attempt_wait']:.1f}s, "
+              f"最多 {t['max_attempts']} 次, 点击前等待 {t['pre_click_wait']:.1f}s, 偏移 {t['offsets'][:3]}")
+    return _TURNSTILE_TUNING
+
+
+def record_turnstile_history(results):
+    records = [r.pop("turnstile") for r in unrecorded(results) if r.get("turnstile")]
+    if not records:
+        return
+    stats = TurnstileStats.load()
+    stats.records.extend(records)
     try:
-        result = sb.execute_script("""
-            var buttons = document.querySelectorAll('button');
-            var hasNextBtn = false;
-            for (var i = 0; i < buttons.length; i++) {
-                if (buttons[i].innerText.includes('NEXT') || buttons[i].innerText.includes('Next')) {
-                    hasNextBtn = true;
-                    break;
-                }
-            }
-            var bodyText = document.body.innerText || '';
-            var hasSuccessTitle = bodyText.includes('Success');
-            var hasSuccessContent = bodyText.includes('성공') || 
-                                    bodyText.includes('갱신') ||
-                                    bodyText.includes('연장');
-            var hasCooldown = bodyText.includes('아직') || 
-                              bodyText.includes('Error');
-            if (hasNextBtn || hasSuccessTitle) {
-                if (hasCooldown && bodyText.includes('아직')) {
-                    return 'cooldown';
-                }
-                if (hasSuccessTitle && hasSuccessContent) {
-                    return 'success';
-                }
-                if (hasNextBtn) {
-                    if (hasCooldown) return 'cooldown';
-                    if (hasSuccessContent) return 'success';
-                }
-            }
-            return null;
-        """)
-        return result
-    except:
-        return None
+        stats.save()
+    except OSError as e:
+        print(f"[Turnstile] 历史保存失败: {e}")
+
+
+def check_result_popup(sb):
+    return read_popup_state(sb)["result"]
 
 
 def check_popup_still_open(sb):
-    try:
-        return sb.execute_script("""
-            var turnstileInput = document.querySelector('input[name="cf-turnstile-response"]');
-            if (!turnstileInput) return false;
-            var buttons = document.querySelectorAll('button');
-            for (var i = 0; i < buttons.length; i++) {
-                var text = buttons[i].innerText || '';
-                if (text.includes('시간추가') && !text.includes('DELETE')) {
-                    var rect = buttons[i].getBoundingClientRect();
-                    if (rect.x > 200 && rect.width > 0) {
-                        return true;
-                    }
-                }
-            }
-            return false;
-        """)
-    except:
-        return False
+    return read_popup_state(sb)["popup_open"]
 
 
 def click_next_button(sb):
@@ -514,135 +2414,408 @@ def click_next_button(sb):
     return False
 
 
-def handle_renewal_popup(sb, screenshot_prefix="", timeout=90):
+def image_dhash(png_bytes):
+    """9x8 差值哈希；没有 Pillow 时退化为内容哈希"""
+    if not PIL_AVAILABLE:
+        return int(hashlib.sha1(png_bytes).hexdigest(), 16)
+    with Image.open(io.BytesIO(png_bytes)) as img:
+        pixels = list(img.convert("L").resize((9, 8)).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def hash_distance(a, b):
+    if not PIL_AVAILABLE:
+        return 0 if a == b else 64
+    return bin(a ^ b).count("1")
+
+
+class ScreenshotManager:
+    """截图管理：CDP 截图到内存，状态不变不截、画面相同不写，解码/压缩/写盘在后台线程完成"""
+
+    def __init__(self, sb):
+        self.sb = sb
+        self.last_state = None
+        self.last_hash = None
+        self.path_hashes = {}
+        self.stats = {"captured": 0, "unchanged_state": 0, "duplicate": 0, "written": 0}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _capture(self):
+        try:
+            return self.sb.driver.execute_cdp_cmd("Page.captureScreenshot", {"format": "png"})["data"]
+        except Exception:
+            return self.sb.driver.get_screenshot_as_base64()
+
+    def snap(self, path, state=None, terminal=False):
+        """非终态且 state 与上次相同时直接跳过；返回 path 以便写入结果"""
+        state_key = json.dumps(state, sort_keys=True, default=str) if state is not None else None
+        if not terminal and state_key is not None and state_key == self.last_state:
+            self.stats["unchanged_state"] += 1
+            return path
+        self.last_state = state_key
+        try:
+            data = self._capture()
+        except Exception as e:
+            print(f"[截图] 失败: {str(e)[:80]}")
+            return path
+        self.stats["captured"] += 1
+        self.queue.put((path, data, terminal))
+        return path
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                print(f"[截图] 写入失败: {str(e)[:80]}")
+            finally:
+                self.queue.task_done()
+
+    def _write(self, path, data, terminal):
+        png = base64.b64decode(data)
+        frame_hash = image_dhash(png)
+        if terminal:
+            duplicate = path in self.path_hashes and \
+                hash_distance(frame_hash, self.path_hashes[path]) <= SCREENSHOT_HASH_DISTANCE
+        else:
+            duplicate = self.last_hash is not None and \
+                hash_distance(frame_hash, self.last_hash) <= SCREENSHOT_HASH_DISTANCE
+        self.last_hash = frame_hash
+        if duplicate:
+            self.stats["duplicate"] += 1
+            return
+        if PIL_AVAILABLE:
+            with Image.open(io.BytesIO(png)) as img:
+                img.save(path, format="PNG", optimize=True)
+        else:
+            with open(path, "wb") as f:
+                f.write(png)
+        self.path_hashes[path] = frame_hash
+        self.stats["written"] += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        st = self.stats
+        print(f"[截图] 捕获 {st['captured']} 张, 状态未变跳过 {st['unchanged_state']}, "
+              f"画面重复 {st['duplicate']}, 写盘 {st['written']}")
+
+
+def handle_renewal_popup(sb, screenshot_prefix="", timeout=90, shots=None):
     screenshot_name = f"{screenshot_prefix}_popup.png" if screenshot_prefix else "popup_fixed.png"
-    turnstile_ready = False
-    
-    for _ in range(20):
-        result = check_result_popup(sb)
-        if result == "cooldown":
-            sb.save_screenshot(screenshot_name)
-            return {"status": "cooldown", "screenshot": screenshot_name}
-        if result == "success":
-            sb.save_screenshot(screenshot_name)
-            return {"status": "success", "screenshot": screenshot_name}
-        if check_turnstile_exists(sb):
-            turnstile_ready = True
-            break
-        time.sleep(1)
+    owns_shots = shots is None
+    if owns_shots:
+        shots = ScreenshotManager(sb)
+    try:
+        with TRACER.span("handle_renewal_popup"):
+            return _handle_renewal_popup(sb, screenshot_prefix, screenshot_name, shots, timeout)
+    finally:
+        if owns_shots:
+            shots.close()
+
+
+def _handle_renewal_popup(sb, screenshot_prefix, screenshot_name, shots, timeout):
+    TRACER.step("popup_wait_turnstile")
+    deadline = time.time() + timeout
+
+    state = wait_popup_until(sb, read_popup_state(sb),
+                             lambda st: st["result"] or st["turnstile"], 20)
+    if state["result"] in ("success", "cooldown"):
+        shots.snap(screenshot_name, terminal=True)
+        return {"status": state["result"], "screenshot": screenshot_name}
 
-    if not turnstile_ready:
-        sb.save_screenshot(screenshot_name)
+    if not state["turnstile"]:
+        shots.snap(screenshot_name, terminal=True)
         return {"status": "error", "message": "未检测到 Turnstile", "screenshot": screenshot_name}
 
+    tuning = get_turnstile_tuning()
+    record = {"ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "auto_solved": False,
+              "attempts": 0, "solved": False, "clicks": []}
+    appeared = time.time()
+
     for _ in range(3):
         sb.execute_script(EXPAND_POPUP_JS)
-        time.sleep(0.5)
+        if get_turnstile_checkbox_coords(sb):
+            break
+        time.sleep(0.2)
+
+    shots.snap(screenshot_name, state=state)
 
-    sb.save_screenshot(screenshot_name)
+    TRACER.step("popup_turnstile_solve")
+    if tuning["pre_click_wait"] > 0:
+        state = wait_popup_until(sb, read_popup_state(sb),
+                                 lambda st: st["solved"] or st["result"], tuning["pre_click_wait"])
+    if state["solved"] or state["result"]:
+        record["auto_solved"] = True
+        record["auto_wait"] = round(time.time() - appeared, 2)
 
-    for attempt in range(6):
-        if check_turnstile_solved(sb):
+    for attempt in range(tuning["max_attempts"]):
+        if state["solved"] or state["result"] or time.time() >= deadline:
             break
+        offset = tuning["offsets"][attempt % len(tuning["offsets"])]
         sb.execute_script(EXPAND_POPUP_JS)
-        time.sleep(0.3)
-        click_turnstile_checkbox(sb)
-        for _ in range(8):
-            time.sleep(0.5)
-            if check_turnstile_solved(sb):
-                break
-        if check_turnstile_solved(sb):
+        time.sleep(0.2)
+        clicked_at = time.time()
+        click_turnstile_checkbox(sb, offset_x=offset)
+        record["attempts"] += 1
+        state = wait_popup_until(sb, read_popup_state(sb), lambda st: st["solved"] or st["result"],
+                                 max(0.5, min(tuning["attempt_wait"], deadline - time.time())))
+        solved = bool(state["solved"] or state["result"])
+        record["clicks"].append({"offset": offset, "solved": solved})
+        if solved:
+            record["solve_time"] = round(time.time() - clicked_at, 2)
             break
-        sb.save_screenshot(f"{screenshot_prefix}_turnstile_{attempt}.png" if screenshot_prefix else f"turnstile_attempt_{attempt}.png")
+        shots.snap(f"{screenshot_prefix}_turnstile_{attempt}.png" if screenshot_prefix else f"turnstile_attempt_{attempt}.png",
+                   state=state)
+    record["solved"] = bool(state["solved"] or state["result"])
 
-    result_timeout = 45
+    TRACER.step("popup_wait_result")
+    result_timeout = min(45, max(5, deadline - time.time()))
     result_start = time.time()
-    last_screenshot_time = 0
 
     while time.time() - result_start < result_timeout:
-        result = check_result_popup(sb)
-        if result == "success":
-            sb.save_screenshot(screenshot_name)
-            time.sleep(1)
-            click_next_button(sb)
-            return {"status": "success", "screenshot": screenshot_name}
-        if result == "cooldown":
-            sb.save_screenshot(screenshot_name)
+        remaining = result_timeout - (time.time() - result_start)
+        state = wait_popup_until(sb, state, lambda st: st["result"], min(5, remaining))
+        if state["result"] in ("success", "cooldown"):
+            shots.snap(screenshot_name, terminal=True)
             time.sleep(1)
             click_next_button(sb)
-            return {"status": "cooldown", "screenshot": screenshot_name}
-        if not check_popup_still_open(sb):
-            time.sleep(2)
-            result = check_result_popup(sb)
-            if result:
-                sb.save_screenshot(screenshot_name)
-                if result == "success":
-                    click_next_button(sb)
-                    return {"status": "success", "screenshot": screenshot_name}
-                elif result == "cooldown":
-                    click_next_button(sb)
-                    return {"status": "cooldown", "screenshot": screenshot_name}
-        if time.time() - last_screenshot_time > 5:
-            sb.save_screenshot(screenshot_name)
-            last_screenshot_time = time.time()
-        time.sleep(1)
-
-    sb.save_screenshot(screenshot_name)
-    return {"status": "timeout", "screenshot": screenshot_name}
-
-
-def check_and_update_cookie(sb, cookie_env, original_cookie_value):
-    try:
-        cookies = sb.get_cookies()
-        for cookie in cookies:
+            return {"status": state["result"], "screenshot": screenshot_name, "turnstile": record}
+        shots.snap(screenshot_name, state=state)
+
+    shots.snap(screenshot_name, terminal=True)
+    return {"status": "timeout", "screenshot": screenshot_name, "turnstile": record}
+
+
+def inject_cookie_cdp(sb, cookie_name, cookie_value, clear=True):
+    """在首次导航前通过 CDP 写入 remember_web，省去两次首页加载"""
+    try:
+        if clear:
+            sb.driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        res = sb.driver.execute_cdp_cmd("Network.setCookie", {
+            "name": cookie_name,
+            "value": cookie_value,
+            "domain": DOMAIN,
+            "path": "/",
+            "secure": ORIGIN.startswith("https://"),
+            "httpOnly": True,
+            "sameSite": "Lax",
+        })
+        return bool(res.get("success", True)) if isinstance(res, dict) else True
+    except Exception as e:
+        print(f"[!] CDP 注入 Cookie 失败，回退到页面注入: {str(e)[:80]}")
+        return False
+
+
+def get_rotated_cookie(sb, original_cookie_value):
+    """浏览器中的 remember_web 若已轮换，返回新的 'name=value'，否则 None"""
+    try:
+        for cookie in sb.get_cookies():
             if cookie.get("name", "").startswith("remember_web"):
                 new_val = cookie.get("value", "")
-                cookie_name = cookie.get("name", "")
                 if new_val and new_val != original_cookie_value:
-                    new_cookie_str = f"{cookie_name}={new_val}"
-                    if asyncio.run(update_github_secret(cookie_env, new_cookie_str)):
-                        return True
-                    else:
-                        return False
+                    return f"{cookie['name']}={new_val}"
                 break
-    except Exception as e:
+    except Exception:
         pass
-    return False
+    return None
+
+
+class AccountContext:
+    """一个账号专用的 CDP 浏览器上下文：Cookie、localStorage、缓存都与其他账号隔离，用完整体销毁"""
+
+    def __init__(self, sb, context_id, target_id, prefetched):
+        self.sb = sb
+        self.context_id = context_id
+        self.target_id = target_id
+        self.prefetched = prefetched
+
+    @classmethod
+    def create(cls, sb, account=None):
+        """创建上下文和其中的标签页；传入 account 时预先写入 Cookie 并在后台加载服务器页"""
+        cdp = sb.driver.execute_cdp_cmd
+        # uc_open_with_reconnect 会断开 chromedriver，上下文不能随 DevTools 会话一起销毁
+        context_id = cdp("Target.createBrowserContext", {"disposeOnDetach": False})["browserContextId"]
+        url = "about:blank"
+        if account:
+            cookie_name, cookie_value = parse_weirdhost_cookie(get_account_cookie(account))
+            server_url = build_server_url(account.get("id", ""))
+            if cookie_name and cookie_value and server_url:
+                try:
+                    cdp("Storage.setCookies", {"browserContextId": context_id, "cookies": [{
+                        "name": cookie_name, "value": cookie_value, "domain": DOMAIN, "path": "/",
+                        "secure": ORIGIN.startswith("https://"), "httpOnly": True, "sameSite": "Lax",
+                    }]})
+                    url = server_url
+                except Exception as e:
+                    print(f"[上下文] 预写入 Cookie 失败，不预加载: {str(e)[:80]}")
+        try:
+            target_id = cdp("Target.createTarget", {
+                "url": url, "browserContextId": context_id, "background": True
+            })["targetId"]
+        except Exception:
+            cdp("Target.disposeBrowserContext", {"browserContextId": context_id})
+            raise
+        return cls(sb, context_id, target_id, url != "about:blank")
+
+    def enter(self):
+        self.sb.driver.switch_to.window(self.target_id)
+        self.bring_to_front()
+        # 每个上下文是独立窗口，窗口位置需要重新计算
+        _WINDOW_OFFSETS.pop(self.sb.driver, None)
+        for backend in _INPUT_BACKENDS.values():
+            if isinstance(backend, XTestInput):
+                backend.forget(self.sb.driver)
+        _ACTIVE_CONTEXTS[self.sb.driver] = self
+
+    def bring_to_front(self):
+        try:
+            self.sb.driver.execute_cdp_cmd("Page.bringToFront", {})
+        except Exception:
+            pass
+
+    def ensure_current(self):
+        """uc_open_with_reconnect 切换到最后一个标签页，可能落到其他上下文，必要时切回本上下文的标签页"""
+        driver = self.sb.driver
+        cdp = driver.execute_cdp_cmd
+        try:
+            if cdp("Target.getTargetInfo", {})["targetInfo"].get("browserContextId") == self.context_id:
+                self.target_id = driver.current_window_handle
+                return
+            for handle in driver.window_handles:
+                info = cdp("Target.getTargetInfo", {"targetId": handle})["targetInfo"]
+                if info.get("browserContextId") == self.context_id and info.get("type") == "page":
+                    driver.switch_to.window(handle)
+                    self.target_id = handle
+                    return
+        except Exception as e:
+            print(f"[上下文] 校验当前标签页失败: {str(e)[:80]}")
+
+    def dispose(self, home_handle):
+        if _ACTIVE_CONTEXTS.get(self.sb.driver) is self:
+            del _ACTIVE_CONTEXTS[self.sb.driver]
+        try:
+            self.sb.driver.switch_to.window(home_handle)
+        except Exception:
+            pass
+        try:
+            self.sb.driver.execute_cdp_cmd("Target.disposeBrowserContext", {"browserContextId": self.context_id})
+        except Exception as e:
+            print(f"[上下文] 销毁失败: {str(e)[:80]}")
+
+
+def open_page(sb, url, reconnect_time):
+    """uc_open_with_reconnect 打开页面；在浏览器上下文中运行时确保仍停留在本账号的标签页"""
+    sb.uc_open_with_reconnect(url, reconnect_time=reconnect_time)
+    context = _ACTIVE_CONTEXTS.get(sb.driver)
+    if context:
+        context.ensure_current()
+
+
+def context_sessions(sb, tasks):
+    """每个账号在独立的浏览器上下文中运行；处理当前账号时，下一个账号的服务器页已在另一个上下文中加载"""
+    home = sb.driver.current_window_handle
+    tasks = iter(tasks)
+    upcoming = next(tasks, None)
+    prefetched = None
+    while upcoming:
+        i, account = upcoming
+        context = prefetched
+        prefetched = None
+        try:
+            if context is None:
+                context = AccountContext.create(sb)
+            context.enter()
+        except Exception as e:
+            print(f"[上下文] 创建浏览器上下文失败，回退为共用上下文: {str(e)[:80]}")
+            if context:
+                context.dispose(home)
+            try:
+                sb.delete_all_cookies()
+            except Exception:
+                pass
+            yield i, account, sb
+            upcoming = next(tasks, None)
+            continue
+
+        upcoming = next(tasks, None)
+        if upcoming and CONTEXT_PREFETCH:
+            try:
+                with TRACER.span("prefetch_context", index=upcoming[0] + 1):
+                    prefetched = AccountContext.create(sb, upcoming[1])
+            except Exception as e:
+                print(f"[上下文] 预加载下一个账号失败: {str(e)[:80]}")
+            # 创建新窗口可能抢走前台，切回当前账号
+            context.bring_to_front()
+        try:
+            yield i, account, sb
+        finally:
+            context.dispose(home)
+    if prefetched:
+        prefetched.dispose(home)
 
 
 def process_single_account(sb, account, account_index):
-    remark = account.get("remark", f"账号{account_index + 1}")
-    server_id = account.get("id", "").strip()
-    cookie_env = account.get("cookie_env", "").strip()
-    display_name = mask_email(remark) if "@" in remark else remark
+    timings = {}
+    start = time.time()
+    shots = ScreenshotManager(sb)
+    SNAPSHOTS.begin(account_index)
+    with TRACER.span("account", collect=timings, index=account_index + 1) as span:
+        try:
+            result = _process_single_account(sb, account, account_index, shots)
+            original_dt = parse_expiry_to_datetime(result.get("original_expiry"))
+            new_dt = parse_expiry_to_datetime(result.get("new_expiry"))
+            SNAPSHOTS.label_outcome(new_dt > original_dt if original_dt and new_dt else None)
+            resources = summarize_resources(result.pop("page_resources", {}))
+            if resources["pages"]:
+                result["resource_sizes"] = resources.pop("sizes")
+                result["resources"] = resources
+                span["args"].update(resource_bytes=resources["bytes"], resource_blocked=resources["blocked"],
+                                    resource_saved=resources["blocked_bytes"])
+        finally:
+            shots.close()
+    result["duration"] = round(time.time() - start, 2)
+    result["timings"] = timings
+    result["webdriver_commands"] = span["commands"]
+    result["execute_script"] = span["scripts"]
+    waits = result.get("waits")
+    if waits:
+        waited, replaced = summarize_waits(waits)
+        print(f"[等待] 合计 {waited:.1f}s，原固定等待 {replaced}s，节省 {replaced - waited:.1f}s")
+    return result
 
-    result = {
-        "remark": remark,
-        "display_name": display_name,
-        "server_id": server_id,
-        "cookie_env": cookie_env,
-        "status": "unknown",
-        "original_expiry": "Unknown",
-        "new_expiry": "Unknown",
-        "message": "",
-        "screenshot": None,
-        "cookie_updated": False,
-        "skipped": False
-    }
+
+def _process_single_account(sb, account, account_index, shots):
+    result = new_result(account, account_index)
+    server_id = result["server_id"]
+    cookie_env = result["cookie_env"]
+    display_name = result["display_name"]
 
     print(f"\n{'=' * 60}")
     print(f"处理账号 [{account_index + 1}]: {display_name}")
     print(f"{'=' * 60}")
 
-    if not server_id or not cookie_env:
+    if not server_id or not (cookie_env or account.get("vault")):
         result["status"] = "error"
         result["message"] = "配置缺失"
+        # 配置问题重试也不会成功，不占用重试的时间预算
+        result["retryable"] = False
         return result
 
-    cookie_str = os.environ.get(cookie_env, "").strip()
+    cookie_str = get_account_cookie(account)
     if not cookie_str:
         result["status"] = "error"
-        result["message"] = f"{cookie_env} 未设置"
+        result["message"] = f"{cookie_env or '账号库 Cookie'} 未设置"
+        result["retryable"] = False
         return result
 
     cookie_name, cookie_value = parse_weirdhost_cookie(cookie_str)
@@ -651,81 +2824,108 @@ def process_single_account(sb, account, account_index):
     if not cookie_name or not cookie_value:
         result["status"] = "error"
         result["message"] = "Cookie 格式错误"
+        result["retryable"] = False
         return result
 
     screenshot_prefix = f"account_{account_index + 1}"
+    waits = []
+    result["waits"] = waits
+    pages = {}
+    result["page_resources"] = pages
 
+    page = None
+    context = _ACTIVE_CONTEXTS.get(sb.driver)
     try:
-        print("\n[步骤1] 设置 Cookie")
-        try:
-            sb.uc_open_with_reconnect(f"https://{DOMAIN}", reconnect_time=3)
-            time.sleep(1)
-            sb.delete_all_cookies()
-        except:
-            pass
-
-        sb.uc_open_with_reconnect(f"https://{DOMAIN}", reconnect_time=3)
-        time.sleep(2)
-
-        # ----------------------------------------------------
-        # 新增调试逻辑：在注入 Cookie 之前强制收集环境信息并截图
-        # ----------------------------------------------------
-        try:
-            current_url = sb.get_current_url()
-            current_title = sb.get_page_title()
-            print(f"[*] 注入前页面 URL: {current_url}")
-            print(f"[*] 注入前页面标题: {current_title}")
-            
-            debug_screenshot_path = f"{screenshot_prefix}_debug_pre_cookie.png"
-            sb.save_screenshot(debug_screenshot_path)
-            print(f"[*] 📸 已保存强制调试截图: {debug_screenshot_path}")
-            
-            if DOMAIN not in current_url:
-                print(f"[!] ⚠️ 警告: 浏览器当前未停留在 {DOMAIN}！这可能会导致注入 Cookie 失败。")
-        except Exception as e:
-            print(f"[!] 获取页面环境信息失败: {e}")
-
-        # ----------------------------------------------------
-        # 异常捕获机制：防止直接崩溃退出
-        # ----------------------------------------------------
-        try:
-            sb.add_cookie({
-                "name": cookie_name, "value": cookie_value,
-                "domain": DOMAIN, "path": "/"
-            })
-            print("[+] Cookie 已成功设置")
-        except Exception as cookie_err:
-            print(f"[!] ❌ 致命错误: 无法注入 Cookie: {cookie_err}")
-            err_screenshot_path = f"{screenshot_prefix}_cookie_fail.png"
-            sb.save_screenshot(err_screenshot_path)
-            result["status"] = "error"
-            result["message"] = "无法注入Cookie(域名不符/已被拦截)"
-            result["screenshot"] = err_screenshot_path
-            return result
-
-        print("\n[步骤2] 获取到期时间")
-        sb.uc_open_with_reconnect(server_url, reconnect_time=5)
-        time.sleep(3)
-
-        if not is_logged_in(sb):
-            sb.add_cookie({
-                "name": cookie_name, "value": cookie_value,
-                "domain": DOMAIN, "path": "/"
-            })
-            sb.uc_open_with_reconnect(server_url, reconnect_time=5)
-            time.sleep(3)
-
-        if not is_logged_in(sb):
-            screenshot_path = f"{screenshot_prefix}_login_failed.png"
-            sb.save_screenshot(screenshot_path)
+        if context and context.prefetched:
+            TRACER.step("step2_load_server_page")
+            wait_for_condition(sb, SERVER_PAGE_READY_JS, "预加载页就绪", replaces=3, waits=waits)
+            page = get_page_state(sb, pages)
+            if page["logged_in"]:
+                print("\n[步骤1-2] 服务器页已在独立上下文中预加载")
+            else:
+                page = None
+
+        if page is None:
+            print("\n[步骤1] 设置 Cookie")
+            TRACER.step("step1_cookie")
+            cdp_injected = COOKIE_INJECTION == "cdp" and \
+                inject_cookie_cdp(sb, cookie_name, cookie_value, clear=not PERSIST_PROFILES)
+            if cdp_injected:
+                print("[+] Cookie 已通过 CDP 注入，直接打开服务器页")
+            else:
+                try:
+                    open_page(sb, ORIGIN, reconnect_time=3)
+                    wait_for_condition(sb, PAGE_READY_JS, "首页加载", replaces=1, waits=waits)
+                    if not PERSIST_PROFILES:
+                        sb.delete_all_cookies()
+                except:
+                    pass
+
+                open_page(sb, ORIGIN, reconnect_time=3)
+                wait_for_condition(sb, PAGE_READY_JS, "首页重载", replaces=2, waits=waits)
+
+                # ----------------------------------------------------
+                # 调试逻辑：在注入 Cookie 之前收集环境信息，异常时截图
+                # ----------------------------------------------------
+                try:
+                    current_url = sb.get_current_url()
+                    current_title = sb.get_page_title()
+                    print(f"[*] 注入前页面 URL: {current_url}")
+                    print(f"[*] 注入前页面标题: {current_title}")
+
+                    if DOMAIN not in current_url:
+                        print(f"[!] ⚠️ 警告: 浏览器当前未停留在 {DOMAIN}！这可能会导致注入 Cookie 失败。")
+                        debug_screenshot_path = shots.snap(f"{screenshot_prefix}_debug_pre_cookie.png", terminal=True)
+                        print(f"[*] 📸 已保存调试截图: {debug_screenshot_path}")
+                except Exception as e:
+                    print(f"[!] 获取页面环境信息失败: {e}")
+
+                # ----------------------------------------------------
+                # 异常捕获机制：防止直接崩溃退出
+                # ----------------------------------------------------
+                try:
+                    sb.add_cookie({
+                        "name": cookie_name, "value": cookie_value,
+                        "domain": DOMAIN, "path": "/"
+                    })
+                    print("[+] Cookie 已成功设置")
+                except Exception as cookie_err:
+                    print(f"[!] ❌ 致命错误: 无法注入 Cookie: {cookie_err}")
+                    err_screenshot_path = shots.snap(f"{screenshot_prefix}_cookie_fail.png", terminal=True)
+                    result["status"] = "error"
+                    result["message"] = "无法注入Cookie(域名不符/已被拦截)"
+                    result["retryable"] = False
+                    result["screenshot"] = err_screenshot_path
+                    return result
+
+            print("\n[步骤2] 获取到期时间")
+            TRACER.step("step2_load_server_page")
+            open_page(sb, server_url, reconnect_time=5)
+            wait_for_condition(sb, SERVER_PAGE_READY_JS, "服务器页加载", replaces=3, waits=waits)
+
+            page = get_page_state(sb, pages)
+            if not page["logged_in"]:
+                if not (cdp_injected and inject_cookie_cdp(sb, cookie_name, cookie_value, clear=False)):
+                    sb.add_cookie({
+                        "name": cookie_name, "value": cookie_value,
+                        "domain": DOMAIN, "path": "/"
+                    })
+                open_page(sb, server_url, reconnect_time=5)
+                wait_for_condition(sb, SERVER_PAGE_READY_JS, "服务器页重试", replaces=3, waits=waits)
+                page = get_page_state(sb, pages)
+
+        if not page["logged_in"]:
+            screenshot_path = shots.snap(f"{screenshot_prefix}_login_failed.png", terminal=True)
             result["status"] = "error"
             result["message"] = "Cookie 失效，请重新获取"
+            result["retryable"] = False
             result["screenshot"] = screenshot_path
             return result
 
-        original_expiry = get_expiry_from_page(sb)
-        remaining_days = get_remaining_days(original_expiry)
+        original_expiry = page["expiry"]
         result["original_expiry"] = original_expiry
+        if page.get("server_name"):
+            print(f"[*] 服务器: {page['server_name']}")
 
         need_renew = should_renew(original_expiry)
         if not need_renew:
@@ -733,37 +2933,39 @@ def process_single_account(sb, account, account_index):
             result["skipped"] = True
             result["new_expiry"] = original_expiry
             result["message"] = "无需续期"
-            if check_and_update_cookie(sb, cookie_env, cookie_value):
-                result["cookie_updated"] = True
+            result["rotated_cookie"] = get_rotated_cookie(sb, cookie_value) or result.get("rotated_cookie")
             return result
 
         print("\n[步骤4] 点击侧栏续期按钮")
+        TRACER.step("step4_click_renew")
         random_delay(1.0, 2.0)
-        sidebar_btn_xpath = "//button//span[contains(text(), '시간추가')]/parent::button"
-        if not sb.is_element_present(sidebar_btn_xpath):
-            sidebar_btn_xpath = "//button[contains(., '시간추가')]"
-
-        if not sb.is_element_present(sidebar_btn_xpath):
-            screenshot_path = f"{screenshot_prefix}_no_button.png"
-            sb.save_screenshot(screenshot_path)
+        if not page["has_renew_button"]:
+            screenshot_path = shots.snap(f"{screenshot_prefix}_no_button.png", terminal=True)
             result["status"] = "error"
             result["message"] = "未找到续期按钮"
             result["screenshot"] = screenshot_path
             return result
 
+        sidebar_btn_xpath = "//button//span[contains(text(), '시간추가')]/parent::button"
+        if not sb.is_element_present(sidebar_btn_xpath):
+            sidebar_btn_xpath = "//button[contains(., '시간추가')]"
+
         sb.click(sidebar_btn_xpath)
-        time.sleep(3)
+        wait_for_condition(sb, POPUP_READY_JS, "续期弹窗出现", timeout=5, replaces=3, waits=waits)
 
         print("\n[步骤5] 处理续期弹窗")
-        popup_result = handle_renewal_popup(sb, screenshot_prefix=screenshot_prefix, timeout=90)
+        TRACER.step("step5_popup")
+        popup_result = handle_renewal_popup(sb, screenshot_prefix=screenshot_prefix, timeout=90, shots=shots)
         result["screenshot"] = popup_result.get("screenshot")
+        result["turnstile"] = popup_result.get("turnstile")
 
         print("\n[步骤6] 验证续期结果")
-        time.sleep(3)
-        sb.uc_open_with_reconnect(server_url, reconnect_time=3)
-        time.sleep(3)
+        TRACER.step("step6_verify")
+        wait_for_condition(sb, POPUP_CLOSED_JS, "弹窗关闭", timeout=3, replaces=3, waits=waits)
+        open_page(sb, server_url, reconnect_time=3)
+        wait_for_condition(sb, SERVER_PAGE_READY_JS, "验证页加载", replaces=3, waits=waits)
 
-        new_expiry = get_expiry_from_page(sb)
+        new_expiry = get_page_state(sb, pages)["expiry"]
         result["new_expiry"] = new_expiry
 
         original_dt = parse_expiry_to_datetime(original_expiry)
@@ -775,6 +2977,7 @@ def process_single_account(sb, account, account_index):
         elif original_dt and new_dt and new_dt > original_dt:
             diff_h = (new_dt - original_dt).total_seconds() / 3600
             result["status"] = "success"
+            result["added_hours"] = round(diff_h, 1)
             result["message"] = f"延长了 {diff_h:.1f} 小时"
         elif popup_result["status"] == "success":
             result["status"] = "success"
@@ -783,8 +2986,7 @@ def process_single_account(sb, account, account_index):
             result["status"] = popup_result["status"]
             result["message"] = popup_result.get("message", "未知状态")
 
-        if check_and_update_cookie(sb, cookie_env, cookie_value):
-            result["cookie_updated"] = True
+        result["rotated_cookie"] = get_rotated_cookie(sb, cookie_value) or result.get("rotated_cookie")
 
     except Exception as e:
         result["status"] = "error"
@@ -793,35 +2995,119 @@ def process_single_account(sb, account, account_index):
     return result
 
 
-def send_summary_report(results):
+def tg_length(text):
+    """Telegram 计算长度使用 UTF-16 码元"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_message(blocks, limit=TG_MESSAGE_LIMIT):
+    """把报告的各个块按顺序装入不超过 limit 的消息；单个块过长时按行拆开，<pre> 表格拆开后每段重复表头"""
+    pieces = []
+    for block in blocks:
+        if tg_length(block) <= limit:
+            pieces.append(block)
+            continue
+        pre = block.startswith("<pre>") and block.endswith("</pre>")
+        rows = block[5:-6].split("\n") if pre else block.split("\n")
+        head = [rows.pop(0)] if pre else []
+        wrap = (lambda body: f"<pre>{body}</pre>") if pre else (lambda body: body)
+        current = []
+        for row in rows:
+            if current and tg_length(wrap("\n".join(head + current + [row]))) > limit:
+                pieces.append(wrap("\n".join(head + current)))
+                current = []
+            current.append(row)
+        if current:
+            pieces.append(wrap("\n".join(head + current)))
+    messages = []
+    for piece in pieces:
+        if messages and tg_length(messages[-1] + "\n" + piece) <= limit:
+            messages[-1] += "\n" + piece
+        else:
+            messages.append(piece)
+    return messages
+
+
+def format_progress(results, total):
+    """进度消息只能原地编辑一条，超过长度时只列出最近完成的账号"""
+    header = [f"🔄 <b>Weirdhost 续期进行中</b> {len(results)}/{total}", ""]
+    lines = [f"{STATUS_ICONS.get(r['status'], '❓')} {r.get('remark', '')}" for r in results]
+    message = "\n".join(header + lines)
+    if tg_length(message) <= TG_MESSAGE_LIMIT:
+        return message
+    counts = {}
+    for r in results:
+        icon = STATUS_ICONS.get(r["status"], "❓")
+        counts[icon] = counts.get(icon, 0) + 1
+    header.insert(1, "  ".join(f"{icon} {n}" for icon, n in counts.items()))
+    budget = TG_MESSAGE_LIMIT - tg_length("\n".join(header)) - 40
+    recent = []
+    for line in reversed(lines):
+        budget -= tg_length(line) + 1
+        if budget < 0:
+            break
+        recent.append(line)
+    omitted = len(lines) - len(recent)
+    return "\n".join(header + [f"… 省略较早完成的 {omitted} 个账号"] + recent[::-1])
+
+
+def format_timing_table(results):
+    """每个账号的耗时表：总计 / 页面加载 / 续期弹窗 / WebDriver 命令数 / 页面流量 / 拦截请求数 / 节省流量"""
+    rows = [r for r in results if r.get("timings")]
+    if not rows:
+        return ""
+    lines = [f"{'账号':<8} {'总计':>6} {'页面':>6} {'弹窗':>6} {'命令':>5} {'流量':>6} {'拦截':>4} {'节省':>6}"]
+    for r in rows:
+        t = r["timings"]
+        page = sum(t.get(k, {}).get("seconds", 0) for k in
+                   ("step1_cookie", "step2_load_server_page", "step6_verify"))
+        popup = t.get("step5_popup", {}).get("seconds", 0)
+        res = r.get("resources", {})
+        lines.append(f"{r.get('remark', '')[:8]:<8} {r.get('duration', 0):>5.0f}s "
+                     f"{page:>5.0f}s {popup:>5.0f}s {r.get('webdriver_commands', 0):>5} "
+                     f"{res.get('bytes', 0) / 1024:>4.0f}KB {res.get('blocked', 0):>4} "
+                     f"{res.get('blocked_bytes', 0) / 1024:>4.0f}KB")
+    return "<pre>" + "\n".join(lines) + "</pre>"
+
+
+def send_summary_report(results, notifier=None):
     success_count = sum(1 for r in results if r["status"] == "success")
     skipped_count = sum(1 for r in results if r["status"] == "skipped")
     error_count = sum(1 for r in results if r["status"] in ["error", "timeout", "unknown", "cooldown"])
 
-    lines = [
+    blocks = ["\n".join([
         "🎁 <b>Weirdhost 多账号续期报告</b>",
         "",
         f"📊 共 {len(results)} 个账号",
         f"✅ 成功: {success_count}  ⏭️ 跳过: {skipped_count}  ❌ 失败: {error_count}",
         "",
         "━━━━━━━━━━━━━━━━━━━━━━"
-    ]
+    ])]
 
     for i, r in enumerate(results):
-        status_icon = {
-            "success": "✅",
-            "cooldown": "⏳",
-            "skipped": "⏭️",
-            "error": "❌",
-            "timeout": "⚠️"
-        }.get(r["status"], "❓")
+        status_icon = STATUS_ICONS.get(r["status"], "❓")
         remark = r.get("remark", f"账号{i+1}")
-        lines.append(f"\n{status_icon} <b>{remark}</b>")
+        lines = [f"\n{status_icon} <b>{remark}</b>"]
         if r.get("message"):
             lines.append(f"   📝 {r['message']}")
+        if r.get("attempts", 1) > 1:
+            history = " → ".join(r.get("attempt_history", []))
+            lines.append(f"   🔁 尝试 {r['attempts']} 次: {history}")
+        if r.get("cookie_rotation") == "updated":
+            lines.append("   🍪 Cookie 已轮换并更新")
+        elif r.get("cookie_rotation") == "failed":
+            lines.append("   🍪 Cookie 已轮换，但更新 Secret 失败")
+        elif r.get("cookie_rotation") == "local":
+            lines.append("   🍪 Cookie 已轮换，未配置写回目标，请手动更新")
+        blocks.append("\n".join(lines))
+
+    timing_table = format_timing_table(results)
+    if timing_table:
+        blocks.extend(["\n⏱️ <b>耗时</b>", timing_table])
+
+    # 账号多时（如 --merge-report 合并数百个账号）超出 Telegram 单条消息长度，按块拆成多条
+    messages = split_message(blocks)
 
-    message = "\n".join(lines)
-    
     screenshot = None
     for r in results:
         if r["status"] in ["success", "cooldown", "error", "timeout"]:
@@ -829,37 +3115,760 @@ def send_summary_report(results):
                 screenshot = r["screenshot"]
                 break
 
+    if notifier is None:
+        with TelegramNotifier() as notifier:
+            _deliver_report(notifier, messages, screenshot)
+    else:
+        _deliver_report(notifier, messages, screenshot)
+
+
+def _deliver_report(notifier, messages, screenshot):
+    if screenshot and len(messages) == 1 and tg_length(messages[0]) <= TG_CAPTION_LIMIT:
+        notifier.send_photo(screenshot, messages[0])
+        return
     if screenshot:
-        sync_tg_notify_photo(screenshot, message)
+        # 图片说明最多 1024 字符，报告过长时分开发送
+        notifier.send_photo(screenshot, "🎁 <b>Weirdhost 多账号续期报告</b>")
+    for i, message in enumerate(messages):
+        if len(messages) > 1:
+            message += f"\n\n<i>({i + 1}/{len(messages)})</i>"
+        notifier.send(message)
+
+
+def open_browser(user_data_dir=None, headless=HEADLESS):
+    chromium_arg = CHROMIUM_ARGS
+    if headless:
+        # 无头模式默认窗口只有 800x600，与 Xvfb 屏幕保持一致，避免页面布局和截图不同
+        chromium_arg += ",--window-size=1920,1080"
+    return SB(
+        uc=True,
+        test=True,
+        locale="ko",
+        headless=False,
+        headless2=headless,
+        user_data_dir=user_data_dir,
+        extension_dir=resource_policy_extension(),
+        chromium_arg=chromium_arg
+    )
+
+
+def profile_key(account):
+    key = account.get("cookie_env") or account.get("id", "default")
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", key.strip())
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def profile_box():
+    """设置了 VAULT_KEY 时返回加密浏览器配置归档用的 SecretBox"""
+    if not NACL_AVAILABLE or not VAULT_KEY:
+        return None
+    try:
+        return SecretBox(base64.b64decode(VAULT_KEY))
+    except Exception as e:
+        print(f"[Profile] VAULT_KEY 无效，不加密归档: {e}")
+        return None
+
+
+def profile_archive(key, box):
+    return os.path.join(PROFILE_ARCHIVE_DIR, f"{key}.tar.gz" + (".enc" if box else ""))
+
+
+def restore_profile(key):
+    """从归档解压出本次运行使用的 user-data-dir（加密归档用 VAULT_KEY 解密）"""
+    user_data_dir = tempfile.mkdtemp(prefix=f"weirdhost_profile_{key}_")
+    box = profile_box()
+    archive = profile_archive(key, box)
+    if not os.path.exists(archive):
+        # 之前未加密保存的归档（不含 Cookie 库）仍可复用
+        archive = profile_archive(key, None)
+    if os.path.exists(archive):
+        try:
+            with open(archive, "rb") as f:
+                data = f.read()
+            if archive.endswith(".enc"):
+                data = box.decrypt(data)
+            with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+                tar.extractall(user_data_dir, filter="data")
+            print(f"[Profile] 复用 {key} 的浏览器配置 ({dir_size(user_data_dir) / 1048576:.1f} MB)")
+        except Exception as e:
+            print(f"[Profile] {key} 归档损坏，使用空配置: {e}")
+            shutil.rmtree(user_data_dir, ignore_errors=True)
+            os.makedirs(user_data_dir, exist_ok=True)
+    return user_data_dir
+
+
+def save_profile(key, user_data_dir):
+    """清理易变文件、按上限裁剪缓存后压缩归档（有 VAULT_KEY 时加密，否则去掉 Cookie 库），并删除临时目录"""
+    box = profile_box()
+    try:
+        for name in PROFILE_VOLATILE + ([] if box else PROFILE_SECRET_FILES):
+            path = os.path.join(user_data_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+        cap = PROFILE_MAX_MB * 1048576
+        for rel in PROFILE_PRUNE_DIRS:
+            if dir_size(user_data_dir) <= cap:
+                break
+            shutil.rmtree(os.path.join(user_data_dir, rel), ignore_errors=True)
+        if dir_size(user_data_dir) > cap:
+            print(f"[Profile] {key} 超过 {PROFILE_MAX_MB} MB 上限，不保存")
+            return
+
+        os.makedirs(PROFILE_ARCHIVE_DIR, exist_ok=True)
+        archive = profile_archive(key, box)
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz", compresslevel=6) as tar:
+            tar.add(user_data_dir, arcname=".")
+        data = buf.getvalue()
+        if box:
+            data = box.encrypt(data)
+        tmp_archive = archive + ".tmp"
+        with open(tmp_archive, "wb") as f:
+            f.write(data)
+        os.replace(tmp_archive, archive)
+        stale = profile_archive(key, None if box else True)
+        if os.path.exists(stale):
+            os.remove(stale)
+        note = "已加密" if box else "不含 Cookie 库"
+        print(f"[Profile] 已保存 {key} ({os.path.getsize(archive) / 1048576:.1f} MB 压缩后，{note})")
+    except (OSError, tarfile.TarError) as e:
+        print(f"[Profile] 保存 {key} 失败: {e}")
+    finally:
+        shutil.rmtree(user_data_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def profile_browser(account):
+    key = profile_key(account)
+    user_data_dir = restore_profile(key)
+    try:
+        with open_browser(user_data_dir=user_data_dir) as sb:
+            yield sb
+    finally:
+        save_profile(key, user_data_dir)
+
+
+def account_sessions(tasks):
+    """为每个账号提供浏览器：持久化配置时每个账号独立启动，否则共用一个（可选每个账号独立的浏览器上下文）"""
+    install_webdriver_counter()
+    if PERSIST_PROFILES:
+        for i, account in tasks:
+            with profile_browser(account) as sb:
+                yield i, account, sb
+    elif BROWSER_CONTEXTS:
+        with open_browser() as sb:
+            yield from context_sessions(sb, tasks)
+    else:
+        with open_browser() as sb:
+            for i, account in tasks:
+                yield i, account, sb
+
+
+def browser_alive(sb):
+    try:
+        sb.driver.window_handles
+        return True
+    except Exception:
+        return False
+
+
+def supervised_sessions(tasks):
+    """account_sessions 外加崩溃恢复：浏览器失去响应后重启并继续处理剩余账号，
+    崩溃时正在处理的账号记为失败，已取出但未开始的账号放回队列"""
+    source = iter(tasks)
+    pushback = []
+    restarts = 0
+
+    while True:
+        handed = []
+
+        def feed():
+            while True:
+                if pushback:
+                    item = pushback.pop(0)
+                else:
+                    item = next(source, None)
+                    if item is None:
+                        return
+                handed.append(item)
+                yield item
+
+        started = set()
+        sessions = account_sessions(feed())
+        try:
+            for i, account, sb in sessions:
+                started.add(i)
+                yield i, account, sb
+                if not browser_alive(sb):
+                    raise RuntimeError(f"处理账号 {i + 1} 后浏览器失去响应")
+            return
+        except Exception as e:
+            try:
+                sessions.close()
+            except Exception:
+                pass
+            restarts += 1
+            if restarts > BROWSER_MAX_RESTARTS:
+                raise
+            pushback[:0] = [item for item in handed if item[0] not in started]
+            print(f"[守护] 浏览器崩溃: {str(e)[:100]}，重启浏览器 ({restarts}/{BROWSER_MAX_RESTARTS})")
+
+
+def run_accounts(indexed_accounts, results, on_result=None, deadline=None):
+    """依次处理账号，结果追加到 results；浏览器崩溃时自动重启。
+    给定 deadline 时，剩余时间不足处理一个账号就不再取下一个账号"""
+    tasks = indexed_accounts
+    if deadline:
+        def tasks_before_deadline():
+            for task in indexed_accounts:
+                if time.time() + RETRY_ACCOUNT_ESTIMATE > deadline:
+                    return
+                yield task
+        tasks = tasks_before_deadline()
+    for n, (i, account, sb) in enumerate(supervised_sessions(tasks)):
+        result = process_single_account(sb, account, i)
+        result["index"] = i
+        results.append(result)
+        if on_result:
+            on_result(i, result)
+        if n < len(indexed_accounts) - 1:
+            time.sleep(random.randint(2, 4))
+    return results
+
+
+def start_virtual_display():
+    """为当前进程启动独立的 Xvfb，避免多个 Chrome 共用一个屏幕导致 xdotool 点错窗口"""
+    if not shutil.which("Xvfb"):
+        return None
+    read_fd, write_fd = os.pipe()
+    try:
+        proc = subprocess.Popen(
+            ["Xvfb", "-displayfd", str(write_fd), "-screen", "0", "1920x1080x24", "-nolisten", "tcp"],
+            pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    finally:
+        os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        display_num = f.readline().strip()
+    if not display_num:
+        proc.terminate()
+        return None
+    os.environ["DISPLAY"] = f":{display_num}"
+    return proc
+
+
+def _account_worker(worker_id, task_queue, result_queue):
+    xvfb = None
+    if HEADLESS:
+        print(f"[W{worker_id}] 无头模式，不启动 Xvfb")
+    else:
+        xvfb = start_virtual_display()
+        if xvfb:
+            print(f"[W{worker_id}] 使用独立显示 {os.environ['DISPLAY']}")
+        else:
+            print(f"[W{worker_id}] ⚠️ 未找到 Xvfb，沿用当前 DISPLAY")
+    try:
+        first = True
+        for i, account, sb in supervised_sessions(iter(task_queue.get, None)):
+            if not first:
+                time.sleep(random.randint(2, 4))
+            first = False
+            result_queue.put(("result", i, process_single_account(sb, account, i)))
+    except Exception as e:
+        print(f"[W{worker_id}] 浏览器异常退出: {str(e)[:100]}")
+    finally:
+        result_queue.put(("done", worker_id, TRACER.events))
+        if xvfb:
+            xvfb.terminate()
+
+
+def run_accounts_parallel(indexed_accounts, workers, on_result=None):
+    """N 个独立浏览器进程并发处理账号，按账号顺序合并结果"""
+    ctx = multiprocessing.get_context("spawn")
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for task in indexed_accounts:
+        task_queue.put(task)
+    for _ in range(workers):
+        task_queue.put(None)
+
+    procs = [
+        ctx.Process(target=_account_worker, args=(w + 1, task_queue, result_queue), daemon=True)
+        for w in range(workers)
+    ]
+    for p in procs:
+        p.start()
+
+    by_index = {}
+    finished = set()
+
+    def handle(message):
+        kind, key, payload = message
+        if kind == "result":
+            by_index[key] = payload
+            if on_result:
+                on_result(key, payload)
+        else:
+            TRACER.events.extend(payload or [])
+            finished.add(key)
+
+    def drain():
+        """读完队列中已写入的消息（进程退出前刚写入的结果可能还在管道中）"""
+        while True:
+            try:
+                handle(result_queue.get(timeout=0.2))
+            except queue.Empty:
+                return
+
+    while len(finished) < workers:
+        try:
+            handle(result_queue.get(timeout=1))
+            continue
+        except queue.Empty:
+            pass
+        # 被 OOM 杀掉或崩溃的进程不会执行 finally，按退出码判定为已结束，其未完成的账号记为失败
+        exited = [w for w, p in enumerate(procs, 1) if w not in finished and p.exitcode is not None]
+        if not exited:
+            continue
+        drain()
+        for w in exited:
+            if w not in finished:
+                finished.add(w)
+                if procs[w - 1].exitcode != 0:
+                    print(f"[W{w}] 进程异常退出 (exitcode={procs[w - 1].exitcode})，未完成的账号记为失败")
+    drain()
+    for p in procs:
+        p.join()
+
+    results = []
+    for i, account in indexed_accounts:
+        if i in by_index:
+            results.append(by_index[i])
+        else:
+            result = new_result(account, i)
+            result["status"] = "error"
+            result["message"] = "浏览器进程异常，未处理"
+            results.append(result)
+    return results
+
+
+def retry_delay(result):
+    """失败结果的重试延迟（秒），按状态退避并逐次翻倍；None 表示不再重试"""
+    base = RETRY_DELAYS.get(result.get("status"))
+    if base is None or result.get("retryable") is False:
+        return None
+    attempts = result.get("attempts", 1)
+    if attempts >= RETRY_MAX_ATTEMPTS:
+        return None
+    return base * 2 ** (attempts - 1)
+
+
+def retry_failed(done, accounts, on_result=None):
+    """把失败的账号放进延迟堆，到点后重试，直到全部完成、达到次数上限或超出时间预算"""
+    deadline = RUN_STARTED + RUN_BUDGET_MINUTES * 60
+    pending = []
+    now = time.time()
+    for i, r in done.items():
+        r.setdefault("attempts", 1)
+        if r.get("resumed"):
+            # 从检查点恢复的账号（如冷却中）本次不再处理
+            continue
+        delay = retry_delay(r)
+        if delay is not None:
+            heapq.heappush(pending, (now + delay, i))
+
+    while pending:
+        ready_at, _ = pending[0]
+        if ready_at + RETRY_ACCOUNT_ESTIMATE > deadline:
+            print(f"[重试] 时间预算不足，放弃 {len(pending)} 个账号的重试")
+            return
+        wait = ready_at - time.time()
+        if wait > 0:
+            print(f"[重试] {len(pending)} 个账号待重试，等待 {wait:.0f} 秒")
+            time.sleep(wait)
+
+        batch = []
+        while pending and pending[0][0] <= time.time():
+            _, i = heapq.heappop(pending)
+            batch.append((i, accounts[i]))
+        print(f"[重试] 重新处理 {len(batch)} 个账号")
+
+        results = []
+        try:
+            run_accounts(batch, results, deadline=deadline)
+        except Exception as e:
+            print(f"[重试] 浏览器异常: {str(e)[:100]}")
+        by_index = {r["index"]: r for r in results}
+        out_of_time = time.time() + RETRY_ACCOUNT_ESTIMATE > deadline
+        unretried = 0
+        for i, account in batch:
+            previous = done[i]
+            if i not in by_index and out_of_time:
+                # 时间预算用尽时未轮到的账号保留上一次的结果
+                unretried += 1
+                continue
+            if i in by_index:
+                result = by_index[i]
+            else:
+                result = new_result(account, i)
+                result.update(status="error", message="浏览器异常，未处理")
+            result["attempts"] = previous["attempts"] + 1
+            result["attempt_history"] = previous.get("attempt_history", [previous["status"]]) + [result["status"]]
+            done[i] = result
+            if on_result:
+                on_result(i, result)
+            delay = retry_delay(result)
+            if delay is not None:
+                heapq.heappush(pending, (time.time() + delay, i))
+        if unretried:
+            print(f"[重试] 时间预算不足，放弃 {unretried + len(pending)} 个账号的重试")
+            return
+
+
+def finalize_results(state, results, notifier, shard_output=None):
+    """提交 Cookie 轮换、保存 Turnstile 历史和状态缓存，并发送汇总报告（分片模式下写入结果文件）"""
+    commit_cookie_rotations(results, defer_vault=bool(shard_output))
+    record_turnstile_history(results)
+    record_resource_sizes(results)
+    record_run_history(results)
+    try:
+        save_state(update_state(state, results))
+    except OSError as e:
+        print(f"[缓存] 状态保存失败: {e}")
+    if shard_output:
+        write_shard_results(shard_output, results)
     else:
-        sync_tg_notify(message)
+        send_summary_report(results, notifier)
+
+
+# 分片结果文件作为 Actions 产物可被下载，只保留合并报告需要的字段
+SHARD_RESULT_FIELDS = (
+    "index", "status", "message", "original_expiry", "new_expiry", "screenshot", "skipped",
+    "cookie_updated", "cookie_rotation", "attempts", "attempt_history",
+    "duration", "timings", "webdriver_commands", "resources",
+)
 
 
-def add_server_time():
+def shard_result(result):
+    """合并报告用的结果：备注（通常是邮箱）和 server_id 只写打码后的值"""
+    entry = {key: result[key] for key in SHARD_RESULT_FIELDS if key in result}
+    entry["remark"] = entry["display_name"] = result.get("display_name", "")
+    entry["server_id"] = mask_server_id(result.get("server_id"))
+    return entry
+
+
+def write_shard_results(path, results):
+    """分片结果写成 JSON，由 --merge-report 合并；只写打码的标识和报告所需字段"""
+    payload = {
+        "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "results": [shard_result(r) for r in results],
+    }
+    vault = get_vault()
+    if vault and vault.rotations:
+        # 账号库的轮换用同一密钥加密后随结果文件传给合并步骤
+        payload["vault_rotations"] = AccountVault.seal(vault.rotations, vault.key)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=1, default=str)
+    os.replace(tmp_path, path)
+    print(f"[分片] {len(results)} 个结果已写入 {path}")
+
+
+def merge_report(paths):
+    """合并各分片的结果文件并发送一份汇总报告"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path) for name in names if name.endswith(".json")
+            ))
+        else:
+            files.append(path)
+
+    results = []
+    vault_rotations = []
+    for path in files:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            shard_results = payload.get("results", [])
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"[分片] 跳过无法读取的结果文件 {path}: {e}")
+            continue
+        if payload.get("vault_rotations"):
+            vault_rotations.append(payload["vault_rotations"])
+        base_dir = os.path.dirname(path)
+        for r in shard_results:
+            # 截图随分片产物一起下载，路径相对结果文件所在目录
+            screenshot = r.get("screenshot")
+            if screenshot and not os.path.exists(screenshot):
+                r["screenshot"] = os.path.join(base_dir, os.path.basename(screenshot))
+            results.append(r)
+    print(f"[分片] 从 {len(files)} 个文件合并 {len(results)} 个结果")
+    if not results:
+        return
+
+    results.sort(key=lambda r: r.get("index", 0))
+    if vault_rotations:
+        commit_vault_rotations(vault_rotations, results)
+    send_summary_report(results)
+
+
+def commit_vault_rotations(blobs, results):
+    """把各分片传来的账号库轮换合并进账号库，重新加密后一次写回"""
+    vault = get_vault()
+    ok = False
+    if vault:
+        for blob in blobs:
+            try:
+                rotations = AccountVault.unseal(blob, vault.key)
+            except (CryptoError, ValueError, TypeError):
+                print("[账号库] 分片中的轮换记录无法解密，已跳过")
+                continue
+            for server_id, cookie in rotations.items():
+                vault.update_cookie(server_id, cookie)
+        ok = vault.commit()
+        print(f"[账号库] 合并 {len(blobs)} 个分片的 Cookie 轮换，{'已重新加密写回' if ok else '写回失败'}")
+    for r in results:
+        if r.get("cookie_rotation") == "pending":
+            r["cookie_updated"] = ok
+            r["cookie_rotation"] = "updated" if ok else "failed"
+
+
+def compute_due_time(result, now=None):
+    """根据续期结果计算下一次处理时间（时间戳）：到期时间减去提前量再加随机抖动"""
+    now = now or time.time()
+    status = result.get("status")
+    if status in ("error", "timeout", "unknown"):
+        return now + DAEMON_RETRY_MINUTES * 60
+    if status == "cooldown":
+        return now + DAEMON_COOLDOWN_HOURS * 3600
+    expiry = result.get("new_expiry")
+    if not parse_expiry_to_datetime(expiry):
+        expiry = result.get("original_expiry")
+    expiry_dt = parse_expiry_to_datetime(expiry)
+    if not expiry_dt:
+        return now + DAEMON_RETRY_MINUTES * 60
+    due = expiry_dt - timedelta(hours=DAEMON_MARGIN_HOURS) + timedelta(minutes=random.uniform(0, DAEMON_JITTER_MINUTES))
+    return max(due.timestamp(), now)
+
+
+def run_daemon():
+    """常驻模式：按每个服务器的到期时间排队，到点才启动浏览器处理"""
     accounts = parse_accounts()
     if not accounts:
         return
 
-    results = []
+    state = load_state()
+    queue_items = []
+    now = time.time()
+    print(f"[Daemon] 初始化 {len(accounts)} 个账号的到期时间")
+    probes = asyncio.run(probe_all_expiry(accounts))
+    for (i, account), probe in zip(enumerate(accounts), probes):
+        expiry = probe["expiry"]
+        if not probe["source"]:
+            expiry = state["servers"].get(account.get("id", "").strip(), {}).get("last_expiry", "Unknown")
+        due = compute_due_time({"status": "skipped", "original_expiry": expiry}, now)
+        if expiry == "Unknown":
+            due = now
+        heapq.heappush(queue_items, (due, i))
+
+    with TelegramNotifier() as notifier:
+        while queue_items:
+            due, _ = queue_items[0]
+            wait = due - time.time()
+            if wait > 0:
+                print(f"[Daemon] 下一个任务 {datetime.fromtimestamp(due):%Y-%m-%d %H:%M:%S}，休眠 {wait / 60:.1f} 分钟")
+                time.sleep(min(wait, DAEMON_MAX_SLEEP))
+                continue
+
+            batch = []
+            while queue_items and queue_items[0][0] <= time.time() + DAEMON_BATCH_WINDOW:
+                _, i = heapq.heappop(queue_items)
+                batch.append((i, accounts[i]))
+            print(f"[Daemon] 处理 {len(batch)} 个到期账号")
+
+            done, remaining = http_precheck(batch) if HTTP_PROBE else ({}, batch)
+            if remaining:
+                results = []
+                try:
+                    run_accounts(remaining, results)
+                except Exception as e:
+                    print(f"[Daemon] 浏览器异常: {str(e)[:100]}")
+                by_index = {r["index"]: r for r in results}
+                for i, account in remaining:
+                    if i in by_index:
+                        done[i] = by_index[i]
+                    else:
+                        done[i] = new_result(account, i)
+                        done[i].update(status="error", message="浏览器异常，未处理")
+
+            batch_results = [done[i] for i in sorted(done)]
+            if remaining:
+                finalize_results(state, batch_results, notifier)
+            else:
+                commit_cookie_rotations(batch_results)
+                record_run_history(batch_results)
+                try:
+                    save_state(update_state(state, batch_results))
+                except OSError as e:
+                    # 磁盘满或权限问题不应终止常驻进程，下一轮会重新保存
+                    print(f"[缓存] 状态保存失败: {e}")
+
+            now = time.time()
+            for i in sorted(done):
+                # 轮换已提交到环境变量或账号库，下一轮从那里读取最新的 Cookie
+                accounts[i].pop("probe_cookie", None)
+                heapq.heappush(queue_items, (compute_due_time(done[i], now), i))
+
+            if TRACE_FILE and remaining:
+                try:
+                    TRACER.write(TRACE_FILE)
+                except OSError as e:
+                    print(f"[Trace] 写入失败: {e}")
+            TRACER.events.clear()
+
+
+def add_server_time(workers=WORKERS, http_probe=HTTP_PROBE, force_refresh=False, shard=None, shard_output=None,
+                    resume=False):
+    accounts = parse_accounts()
+    if not accounts:
+        return
+
+    if shard:
+        shard_output = shard_output or f"weirdhost_shard_{shard[0]}of{shard[1]}.json"
+        print(f"[分片] 第 {shard[0]}/{shard[1]} 片，结果写入 {shard_output}，由 --merge-report 统一通知")
     try:
-        with SB(
-            uc=True,
-            test=True,
-            locale="ko",
-            headless=False,
-            chromium_arg="--disable-dev-shm-usage,--no-sandbox,--disable-gpu,--disable-software-rasterizer,--disable-background-timer-throttling"
-        ) as sb:
-            for i, account in enumerate(accounts):
-                result = process_single_account(sb, account, i)
-                results.append(result)
-                if i < len(accounts) - 1:
-                    time.sleep(random.randint(2, 4))
-    except Exception as e:
-        if results:
-            send_summary_report(results)
+        # 分片模式只写结果文件，Telegram 通知由合并步骤发送
+        with TelegramNotifier(token="" if shard else None) as notifier:
+            _add_server_time(accounts, notifier, workers, http_probe, force_refresh, shard, shard_output, resume)
+    finally:
+        if TRACE_FILE:
+            try:
+                TRACER.write(TRACE_FILE)
+            except OSError as e:
+                print(f"[Trace] 写入失败: {e}")
+
+
+def _add_server_time(accounts, notifier, workers, http_probe, force_refresh, shard=None, shard_output=None,
+                     resume=False):
+    state = load_state()
+    indexed_accounts = select_shard(list(enumerate(accounts)), shard)
+    total = len(indexed_accounts)
+    done = {}
+    if resume:
+        done, indexed_accounts = load_checkpoint(indexed_accounts)
+    else:
+        reset_checkpoint()
+    if not force_refresh:
+        cached, indexed_accounts = state_precheck(state, indexed_accounts)
+        done.update(cached)
+    if http_probe and indexed_accounts:
+        probed, indexed_accounts = http_precheck(indexed_accounts)
+        done.update(probed)
+
+    def progress(i, result):
+        done[i] = result
+        append_checkpoint(i, result)
+        notifier.update_status(format_progress([done[k] for k in sorted(done)], total))
+
+    def report():
+        results = []
+        for i in sorted(done):
+            done[i]["index"] = i
+            results.append(done[i])
+        rotated = [r for r in results if r.get("rotated_cookie")]
+        finalize_results(state, results, notifier, shard_output)
+        # 轮换已提交（或已随分片结果交给合并步骤），更新检查点，之后 --resume 不必再处理这些账号
+        for r in rotated:
+            if r.get("cookie_rotation") != "failed":
+                append_checkpoint(r["index"], r)
+        mark_checkpoint_recorded()
+
+    if not indexed_accounts:
+        report()
         return
 
-    send_summary_report(results)
+    notifier.start_status(format_progress([done[k] for k in sorted(done)], total))
+
+    workers = max(1, min(workers, len(indexed_accounts)))
+    if workers > 1:
+        print(f"[+] 并发模式: {workers} 个浏览器进程")
+        results = run_accounts_parallel(indexed_accounts, workers, on_result=progress)
+        done.update({i: r for (i, _), r in zip(indexed_accounts, results)})
+    else:
+        try:
+            run_accounts(indexed_accounts, [], on_result=progress)
+        except Exception as e:
+            print(f"[!] 浏览器多次重启仍失败，停止处理: {str(e)[:100]}")
+        for i, account in indexed_accounts:
+            if i not in done:
+                done[i] = new_result(account, i)
+                done[i].update(status="error", message="浏览器异常，未处理")
+
+    retry_failed(done, accounts, on_result=progress)
+    report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Weirdhost 多账号自动续期")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="并发浏览器进程数 (默认取 WORKERS 环境变量, 1 为串行)")
+    parser.add_argument("--no-http-probe", dest="http_probe", action="store_false", default=HTTP_PROBE,
+                        help="跳过 HTTP 预检，所有账号都启动浏览器")
+    parser.add_argument("--force-refresh", action="store_true",
+                        help="忽略状态缓存，重新检查所有账号")
+    parser.add_argument("--resume", action="store_true",
+                        help="从检查点继续：跳过 CHECKPOINT_WINDOW_HOURS 内已完成的账号")
+    parser.add_argument("--daemon", action="store_true",
+                        help="常驻模式：按到期时间排队，到点才续期（适合自建服务器）")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="只处理按 server_id 哈希分到第 I 片（共 N 片）的账号，结果写入 JSON 而不发送通知")
+    parser.add_argument("--shard-output", metavar="PATH",
+                        help="分片结果文件路径 (默认 weirdhost_shard_IofN.json)")
+    parser.add_argument("--merge-report", nargs="+", metavar="PATH",
+                        help="合并分片结果文件（或包含它们的目录）并发送一份汇总报告")
+    parser.add_argument("--seal-vault", metavar="JSON",
+                        help="把明文账号 JSON 文件（- 为标准输入）加密成 ACCOUNT_VAULT，使用或生成 VAULT_KEY")
+    parser.add_argument("--report", nargs="*", metavar="PATH",
+                        help="统计运行历史（默认 STATE_DIR/history.jsonl）：耗时分位、各状态占比和最低剩余天数")
+    parser.add_argument("--days", type=float, help="--report 只统计最近 N 天")
+    parser.add_argument("--since", help="--report 窗口起点，如 2026-01-01 或 '2026-01-01 08:00:00'")
+    parser.add_argument("--until", help="--report 窗口终点（含当天）")
+    parser.add_argument("--report-json", metavar="PATH", help="--report 的统计结果另存为 JSON")
+    args = parser.parse_args(argv)
+    if args.report is not None:
+        # 只给日期时补全时间，使字符串比较覆盖整天
+        since = args.since and (args.since + " 00:00:00")[:19]
+        until = args.until and (args.until + " 23:59:59")[:19]
+        print_history_report(args.report, days=args.days, since=since, until=until, json_path=args.report_json)
+        return
+    if args.seal_vault:
+        seal_vault(args.seal_vault)
+        return
+    if args.merge_report:
+        merge_report(args.merge_report)
+        return
+    if args.daemon:
+        run_daemon()
+        return
+    add_server_time(workers=args.workers, http_probe=args.http_probe, force_refresh=args.force_refresh,
+                    shard=args.shard, shard_output=args.shard_output, resume=args.resume)
+
 
 if __name__ == "__main__":
-    add_server_time()
+    main()